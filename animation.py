@@ -0,0 +1,113 @@
+import math
+import zlib
+from lazyimport import lazyImport
+numpy = lazyImport("numpy")
+
+# Precomputed color ramps for the wind and lightning animations.
+# Every LED is assigned one ramp whenever new weather arrives, after that a frame
+# only needs to look up each LED's ramp at its own position in the animation cycle.
+# If numpy is installed, a frame is computed for all LEDs at once with a few array operations.
+
+# Kinds of animation an airport can show
+KIND_STATIC = 0
+KIND_WINDY = 1
+KIND_HIGH_WINDS = 2
+KIND_LIGHTNING = 3
+KIND_LIGHTNING_WINDY = 4
+KIND_LIGHTNING_HIGH_WINDS = 5
+NUM_KINDS = 6
+
+def mixColors(colorFrom, colorTo, amount, gamma):
+    """Blend two colors, amount 0.0 is colorFrom and 1.0 is colorTo, blended evenly in perceived brightness"""
+    return tuple(int(round(255 * (((a / 255) ** (1 / gamma)) * (1 - amount) + ((b / 255) ** (1 / gamma)) * amount) ** gamma))
+        for a, b in zip(colorFrom, colorTo))
+
+def windAmount(t, smooth):
+    """Share of the wind color at position t (0.0 to 1.0) of the cycle, peaking half way through"""
+    if smooth:
+        return (1 - math.cos(2 * math.pi * t)) / 2
+    return 1.0 if t >= 0.5 else 0.0
+
+def lightningAmount(t, smooth):
+    """Share of the lightning color at position t of the cycle, flashing during the first half"""
+    if t >= 0.5:
+        return 0.0
+    if smooth:
+        return (1 - 2 * t) ** 2
+    return 1.0
+
+def buildRamp(color, windColor, highWindsColor, lightningColor, kind, cycleFrames, smooth, gamma):
+    """Colors of one full animation cycle of an airport with the given kind of animation"""
+    ramp = []
+    for frame in range(cycleFrames):
+        t = frame / cycleFrames
+        current = color
+        if kind in (KIND_WINDY, KIND_LIGHTNING_WINDY):
+            current = mixColors(color, windColor, windAmount(t, smooth), gamma)
+        elif kind in (KIND_HIGH_WINDS, KIND_LIGHTNING_HIGH_WINDS):
+            current = mixColors(color, highWindsColor, windAmount(t, smooth), gamma)
+        if kind in (KIND_LIGHTNING, KIND_LIGHTNING_WINDY, KIND_LIGHTNING_HIGH_WINDS) and t < 0.5:
+            current = mixColors(color, lightningColor, lightningAmount(t, smooth), gamma)
+        ramp.append(current)
+    return ramp
+
+def phaseOffsets(airports, cycleFrames):
+    """A fixed position in the animation cycle for every airport, so they don't all blink in sync"""
+    return [zlib.crc32(airportcode.encode()) % cycleFrames for airportcode in airports]
+
+class Animation:
+    """Looks up the color of every LED for a frame from the precomputed ramps
+
+    steady holds for every ramp the index of the ramp whose first color is shown while nothing is animated,
+    e.g. the plain flight category color of a windy airport. By default every ramp rests at its own first color.
+    """
+
+    def __init__(self, ramps, ledCount, steady = None):
+        self.cycleFrames = len(ramps[0])
+        steady = list(steady) if steady is not None else list(range(len(ramps)))
+        if numpy is not None:
+            # ramps[state, position in cycle] is an (R, G, B) row
+            self.ramps = numpy.array(ramps, dtype=numpy.uint8)
+            self.steady = numpy.array(steady, dtype=numpy.intp)
+        else:
+            self.ramps = ramps
+            self.steady = steady
+        self.setStates([0] * ledCount, [0] * ledCount)
+
+    def setStates(self, states, phases):
+        """states holds the index into ramps of every LED, phases its offset into the animation cycle"""
+        if numpy is not None:
+            self.states = numpy.array(states, dtype=numpy.intp)
+            self.phases = numpy.array(phases, dtype=numpy.intp)
+        else:
+            self.states = list(states)
+            self.phases = list(phases)
+
+    def updateStates(self, indices, states):
+        """Change the ramp index of only the LEDs at indices"""
+        if numpy is not None:
+            self.states[numpy.array(indices, dtype=numpy.intp)] = states
+        else:
+            for i, state in zip(indices, states):
+                self.states[i] = state
+
+    def frame(self, frameNumber, brightness = None):
+        """Colors of all LEDs, scaled by the brightness of every LED if given"""
+        if numpy is not None:
+            return self.scale(self.ramps[self.states, (frameNumber + self.phases) % self.cycleFrames], brightness)
+        ramps = self.ramps
+        cycleFrames = self.cycleFrames
+        return self.scale([ramps[state][(frameNumber + phase) % cycleFrames] for state, phase in zip(self.states, self.phases)], brightness)
+
+    def steadyFrame(self, brightness = None):
+        """Colors of all LEDs without any wind or lightning animation, scaled by the brightness of every LED if given"""
+        if numpy is not None:
+            return self.scale(self.ramps[self.steady[self.states], 0], brightness)
+        return self.scale([self.ramps[self.steady[state]][0] for state in self.states], brightness)
+
+    def scale(self, colors, brightness):
+        if brightness is None:
+            return colors
+        if numpy is not None:
+            return (colors * brightness[:, None]).astype(numpy.uint8)
+        return [(int(g * b), int(r * b), int(bl * b)) for (g, r, bl), b in zip(colors, brightness)]
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+# Benchmark for the hot paths of metar.py that runs on any machine.
+# The recorded METAR response and suntimes in fixtures/ are replayed against the stand-in
+# board, neopixel and displaymetar modules in stubs/, so no Raspberry Pi or network is needed.
+#
+# python3 benchmark/benchmark.py                  run with the recorded stations
+# python3 benchmark/benchmark.py --stations 1000  scale the recorded stations up to 1000 synthetic ones
+# python3 benchmark/benchmark.py --no-numpy       force the plain python code paths
+# python3 benchmark/benchmark.py --strips 4       spread the stations over 4 LED strips
+# python3 benchmark/benchmark.py --log metarlog.bin  use weather recorded by metar.py instead of the fixtures
+
+import os
+import sys
+import csv
+import re
+import argparse
+import contextlib
+import resource
+import tempfile
+from time import monotonic, perf_counter
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(BENCHMARK_DIR, "fixtures")
+sys.path[:0] = [os.path.join(BENCHMARK_DIR, "stubs"), os.path.dirname(BENCHMARK_DIR)]
+
+import neopixel
+import displaymetar
+import metar
+import metarfetch
+import animation
+import framebuffer
+import stationstate
+import metarlog
+
+def loadFixtures():
+    with open(os.path.join(FIXTURES_DIR, "metars.xml"), "rb") as f:
+        xml = f.read()
+    with open(os.path.join(FIXTURES_DIR, "airports.csv"), newline='') as f:
+        airports = list(csv.DictReader(f))
+    with open(os.path.join(FIXTURES_DIR, "suntimes.csv"), newline='') as f:
+        suntimes = list(csv.DictReader(f))
+    return xml, airports, suntimes
+
+def splitFixture(xml):
+    """(head, METAR blocks by station, tail) of a recorded response"""
+    text = xml.decode()
+    head = text[:text.index("<METAR>")]
+    tail = text[text.rindex("</METAR>") + len("</METAR>"):]
+    blocks = {}
+    for block in re.findall(r"<METAR>.*?</METAR>", text, re.S):
+        stationId = re.search(r"<station_id>(\w+)</station_id>", block).group(1)
+        blocks.setdefault(stationId, []).append(block)
+    return head, blocks, tail
+
+def scaleFixtures(xml, airports, suntimes, stations):
+    """Clone the recorded stations into the given number of synthetic stations"""
+    head, blocks, tail = splitFixture(xml)
+    templates = [row for row in airports if row['code'] in blocks]
+    suntimesByCode = {row['code']: row for row in suntimes}
+    scaledBlocks = []
+    scaledAirports = []
+    scaledSuntimes = []
+    for n in range(stations):
+        template = templates[n % len(templates)]
+        code = "S%04d" % n
+        for block in blocks[template['code']]:
+            scaledBlocks.append(block.replace(template['code'], code))
+        scaledAirports.append({'code': code, 'lat': template['lat'], 'lon': template['lon']})
+        if template['code'] in suntimesByCode:
+            scaledSuntimes.append(dict(suntimesByCode[template['code']], code=code))
+    return (head + "\n    ".join(scaledBlocks) + tail).encode(), scaledAirports, scaledSuntimes
+
+def logFixtures(path, at, airports):
+    """Recorded response and airports of the weather at the given time in a METAR_LOG_FILE"""
+    snapshotLog = metarlog.SnapshotLog(path)
+    if not snapshotLog.times:
+        sys.exit("No records in " + path)
+    state = snapshotLog.stateAt(snapshotLog.find(metarlog.parseTime(at)) if at else len(snapshotLog.times) - 1)
+    # The log has no coordinates, use the ones of the recorded fixtures where there are any
+    locations = {row['code']: row for row in airports}
+    return metarlog.toXml(state).encode(), [{'code': code, 'lat': locations.get(code, {}).get('lat', 0), 'lon': locations.get(code, {}).get('lon', 0)} for code in state]
+
+def writeCsv(path, rows, fieldnames):
+    with open(path, "w", newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+def benchmarkParse(xml, stations, repeat):
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        start = perf_counter()
+        for _ in range(repeat):
+            conditionDict, stationList = metar.parseMetars(xml, None)
+        elapsed = (perf_counter() - start) / repeat
+    print("Parse:                 %.2f ms per 100 stations (%d stations, %d bytes)" % (elapsed * 1000 * 100 / max(1, stations), len(conditionDict), len(xml)))
+    return conditionDict
+
+def benchmarkRender(airports, conditionDict, suntimes, frames):
+    codes = [row['code'] for row in airports]
+    ledCount = sum(count for name, pin, count in metar.getStripConfig())
+    framesPerTick = max(1, int(round(metar.BLINK_SPEED * metar.ANIMATION_FPS)))
+    cycleFrames = 2 * framesPerTick
+    ledAnimation = animation.Animation(metar.buildAnimationRamps(cycleFrames), ledCount)
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        ledAnimation.setStates(*metar.getLedStates(codes, conditionDict, cycleFrames, ledCount))
+    sunSchedule = metar.SunSchedule(codes, {row['code']: row for row in suntimes}, metar.datetime.now().date(), ledCount)
+    pixels = framebuffer.StripGroup([neopixel.NeoPixel(pin, count, auto_write = False) for name, pin, count in metar.getStripConfig()])
+    showsBefore = neopixel.NeoPixel.showCount
+    times = []
+    for frameNumber in range(frames):
+        start = perf_counter()
+        pixels.setFrame(ledAnimation.frame(frameNumber, sunSchedule.brightness(metar.time_now())))
+        pixels.show()
+        times.append(perf_counter() - start)
+    print("Render:                %.3f ms per frame (p95 %.3f ms, %d LEDs, %d frames)" % (sum(times) / len(times) * 1000, percentile(times, 95) * 1000, ledCount, frames))
+    print("show() calls:          %d of %d frames, %d skipped unchanged" % (neopixel.NeoPixel.showCount - showsBefore, pixels.framesRendered, pixels.framesSkipped))
+
+def benchmarkUpdate(xml, airports, changes):
+    """Time applying a new snapshot in which only a few stations changed, against recalculating every LED"""
+    codes = [row['code'] for row in airports]
+    ledCount = sum(count for name, pin, count in metar.getStripConfig())
+    cycleFrames = 2 * max(1, int(round(metar.BLINK_SPEED * metar.ANIMATION_FPS)))
+    ledAnimation = animation.Animation(metar.buildAnimationRamps(cycleFrames), ledCount)
+    stationStore = stationstate.StationStore()
+    ledIndex = metar.getLedIndex(codes)
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        conditionDict, stationList = metar.parseMetars(xml, None)
+        newConditionDict, stationList = metar.parseMetars(xml, None)
+        for stationId in sorted(newConditionDict)[:changes]:
+            newConditionDict[stationId].flightCategory = "LIFR" if newConditionDict[stationId].flightCategory != "LIFR" else "VFR"
+        metar.updateStations(stationStore, codes, ledIndex, conditionDict, ledAnimation)
+        start = perf_counter()
+        metar.updateStations(stationStore, codes, ledIndex, newConditionDict, ledAnimation)
+        incremental = perf_counter() - start
+        start = perf_counter()
+        ledAnimation.setStates(*metar.getLedStates(codes, newConditionDict, cycleFrames, ledCount))
+        full = perf_counter() - start
+    print("Snapshot update:       %.2f ms for %d changed stations, %.2f ms for all LEDs" % (incremental * 1000, changes, full * 1000))
+
+def benchmarkRun(xml, airports, seconds):
+    """Run metar.main() end to end with the fetch replaced by the recorded response"""
+    timestamps = {}
+    head, blocks, tail = splitFixture(xml)
+
+    def fetchUrl(url, timeout, etag = None, lastModified = None, pool = None):
+        # Answer every shard with only the stations it asked for
+        timestamps.setdefault("fetch", perf_counter())
+        ids = re.search(r"ids=([^&]*)", url).group(1).split(",")
+        return (head + "\n    ".join(block for stationId in ids for block in blocks.get(stationId, [])) + tail).encode(), None, None
+
+    originalShow = neopixel.NeoPixel.show
+    def show(self):
+        timestamps.setdefault("firstFrame", perf_counter())
+        originalShow(self)
+
+    metarfetch.fetchUrl = fetchUrl
+    neopixel.NeoPixel.show = show
+    # Simulated time, sleeping only advances the clock the main loop schedules its frames with
+    clock = [monotonic()]
+    metar.monotonic = lambda: clock[0]
+    metar.sleep = lambda seconds: clock.__setitem__(0, clock[0] + seconds)
+    metar.ACTIVATE_EXTERNAL_METAR_DISPLAY = True
+    metar.STATUS_PORT = None
+    metar.BLINK_TOTALTIME_SECONDS = seconds
+    showsBefore = neopixel.NeoPixel.showCount
+    start = perf_counter()
+    try:
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            metar.main()
+    finally:
+        neopixel.NeoPixel.show = originalShow
+    elapsed = perf_counter() - start
+    print("Fetch to first frame:  %.1f ms" % ((timestamps["firstFrame"] - timestamps["fetch"]) * 1000))
+    print("Full run:              %.1f ms for %d simulated seconds, %d show() calls, %d display updates" % (elapsed * 1000, seconds, neopixel.NeoPixel.showCount - showsBefore, displaymetar.outputCount))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark metar.py with recorded weather and stub LED hardware")
+    parser.add_argument("--stations", type=int, default=0, help="scale the recorded stations up to this many synthetic stations")
+    parser.add_argument("--frames", type=int, default=300, help="frames to render in the render benchmark")
+    parser.add_argument("--repeat", type=int, default=20, help="how often to repeat the parse benchmark")
+    parser.add_argument("--seconds", type=int, default=10, help="simulated BLINK_TOTALTIME_SECONDS of the full run")
+    parser.add_argument("--strips", type=int, default=1, help="split the airports over this many LED strips")
+    parser.add_argument("--log", help="use the weather recorded in this METAR_LOG_FILE instead of the fixtures")
+    parser.add_argument("--at", help="local time of the recorded weather to use as YYYY-MM-DD HH:MM, the newest by default")
+    parser.add_argument("--no-numpy", action="store_true", help="use the plain python code paths even if numpy is installed")
+    args = parser.parse_args()
+
+    if args.no_numpy:
+        metar.numpy = animation.numpy = framebuffer.numpy = None
+    print("numpy:                 " + ("not used" if animation.numpy is None else animation.numpy.__version__))
+
+    xml, airports, suntimes = loadFixtures()
+    if args.log:
+        xml, airports = logFixtures(args.log, args.at, airports)
+    if args.stations > 0:
+        xml, airports, suntimes = scaleFixtures(xml, airports, suntimes, args.stations)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # metar.py reads suntimes.csv and writes its cache relative to the working directory
+        os.chdir(workdir)
+        if args.strips > 1:
+            # Consecutive blocks of airports go to the same strip, the legend goes on the last one
+            perStrip = -(-len(airports) // args.strips)
+            for n, row in enumerate(airports):
+                row['strip'] = "strip%d" % (n // perStrip)
+            metar.LED_STRIPS = [("strip%d" % n, metar.LED_PIN, perStrip + (7 if n == args.strips - 1 else 0)) for n in range(args.strips)]
+        writeCsv("airports.csv", airports, ["code", "lat", "lon", "strip"])
+        writeCsv("suntimes.csv", suntimes, ["code", "twilight_start", "sunrise", "sunset", "twilight_end"])
+        metar.AIRPORTS_FILE = os.path.join(workdir, "airports.csv")
+        metar.DISPLAY_AIRPORTS_FILE = os.path.join(workdir, "displayairports")
+        metar.CONFIG_FILE = os.path.join(workdir, "metarconfig.json")
+        metar.METAR_CACHE_FILE = None
+        # Room for the legend after the last airport
+        metar.LED_COUNT = len(airports) + 7
+        metar.SHOW_LEGEND = True
+        # Keep the recorded suntimes instead of recalculating them for today
+        os.utime("suntimes.csv")
+
+        stations = len([row for row in airports if row['code'] != "NULL"])
+        conditionDict = benchmarkParse(xml, stations, args.repeat)
+        benchmarkRender(airports, conditionDict, suntimes, args.frames)
+        benchmarkUpdate(xml, airports, 5)
+        benchmarkRun(xml, airports, args.seconds)
+        os.chdir(BENCHMARK_DIR)
+
+    # ru_maxrss is reported in kilobytes on Linux
+    print("Peak RSS:              %.1f MB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+# Stand-in for the Adafruit board module so metar.py can be benchmarked without a Raspberry Pi
+
+D18 = 18
+D21 = 21
+SCL = 3
+SDA = 2
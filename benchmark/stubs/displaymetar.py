@@ -0,0 +1,16 @@
+# Stand-in for displaymetar.py, counts the frames sent to the external display
+
+outputCount = 0
+
+def startDisplay():
+    return object()
+
+def shutdownDisplay(disp):
+    pass
+
+def clearScreen(disp):
+    pass
+
+def outputMetar(disp, station, condition):
+    global outputCount
+    outputCount += 1
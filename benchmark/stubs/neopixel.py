@@ -0,0 +1,37 @@
+# Stand-in for the Adafruit neopixel module, keeps the pixels in memory and counts show() calls
+
+RGB = "RGB"
+GRB = "GRB"
+
+class NeoPixel:
+    # Totals over all strips, read by the benchmark
+    showCount = 0
+    strips = []
+
+    def __init__(self, pin, n, brightness = 1.0, pixel_order = None, auto_write = True):
+        self.pin = pin
+        self.brightness = brightness
+        self.auto_write = auto_write
+        self.buffer = [(0, 0, 0)] * n
+        NeoPixel.strips.append(self)
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def __getitem__(self, index):
+        return self.buffer[index]
+
+    def __setitem__(self, index, color):
+        if isinstance(index, slice):
+            self.buffer[index] = [tuple(c) for c in color]
+        else:
+            self.buffer[index] = tuple(color)
+
+    def fill(self, color):
+        self.buffer = [tuple(color)] * len(self.buffer)
+
+    def show(self):
+        NeoPixel.showCount += 1
+
+    def deinit(self):
+        pass
@@ -10,10 +10,23 @@ except ImportError:
 # This additional file is to support the functionality for an external display
 # If you only want to have the LEDs light up, then you do not need this file
 
+fontLarge = None
+fontSmall = None
+# Rendered image of every station together with the lines of text it shows
+frameCache = {}
+# Bytes of the image currently on the display
+shownFrame = None
+
+def loadFonts():
+	global fontLarge, fontSmall
+	fontLarge = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSansMono-Bold.ttf', 16)
+	fontSmall = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf', 10)
+
 def startDisplay():
 	if noDisplayLibraries:
 		return None
 
+	loadFonts()
 	i2c = busio.I2C(SCL, SDA)
 	disp = adafruit_ssd1306.SSD1306_I2C(128, 64, i2c)
 	disp.poweron()
@@ -26,18 +39,25 @@ def shutdownDisplay(disp):
 	disp.poweroff()
 
 def clearScreen(disp):
+	global shownFrame
 	if noDisplayLibraries:
 		return
 
 	disp.fill(0)
 	disp.show()
+	shownFrame = None
 	
-def outputMetar(disp, station, condition):
-	if noDisplayLibraries:
-		return
+def metarLines(station, condition):
+	"""All text shown for a station, used to tell if its cached image is still up to date"""
+	return (station + "-" + condition.flightCategory,
+		condition.obsTime.strftime("%H:%MZ"),
+		condition.windDir + "@" + str(condition.windSpeed) + ("G" + str(condition.windGustSpeed) if condition.windGust else ""),
+		str(condition.vis) + "SM " + condition.obs,
+		str(condition.tempC) + "C/" + str(condition.dewpointC) + "C",
+		"A" + str(condition.altimHg) + "Hg",
+		tuple(cover + ("@" + str(cloudBaseFt) if cloudBaseFt > 0 else "") for cover, cloudBaseFt in condition.skyConditions))
 
-	width = disp.width
-	height = disp.height
+def renderMetar(width, height, lines):
 	padding = -2
 	x = 0
 	image = Image.new("1", (width, height))
@@ -48,23 +68,22 @@ def outputMetar(disp, station, condition):
 	top = padding
 	bottom = height - padding
 
-	fontLarge = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSansMono-Bold.ttf', 16)
-	fontSmall = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf', 10)
+	title, obsTime, wind, visibility, temperature, altimeter, skyConditions = lines
 	
 	draw.line([(x + 62, top + 18), (x + 62, bottom)], fill=255, width=1)
 	
-	draw.text((x, top + 0), station + "-" + condition["flightCategory"], font=fontLarge, fill=255)
-	draw.text((x + 90, top + 0), condition["obsTime"].strftime("%H:%MZ"), font=fontSmall, fill=255)
+	draw.text((x, top + 0), title, font=fontLarge, fill=255)
+	draw.text((x + 90, top + 0), obsTime, font=fontSmall, fill=255)
 	
-	draw.text((x, top + 15), condition["windDir"] + "@" + str(condition["windSpeed"]) + ("G" + str(condition["windGustSpeed"]) if condition["windGust"] else ""), font=fontSmall, fill=255)
-	draw.text((x + 64, top + 15), str(condition["vis"]) + "SM " + condition["obs"], font=fontSmall, fill=255)
-	draw.text((x, top + 25), str(condition["tempC"]) + "C/" + str(condition["dewpointC"]) + "C", font=fontSmall, fill=255)
-	draw.text((x + 64, top + 25), "A" + str(condition["altimHg"]) + "Hg", font=fontSmall, fill=255)
+	draw.text((x, top + 15), wind, font=fontSmall, fill=255)
+	draw.text((x + 64, top + 15), visibility, font=fontSmall, fill=255)
+	draw.text((x, top + 25), temperature, font=fontSmall, fill=255)
+	draw.text((x + 64, top + 25), altimeter, font=fontSmall, fill=255)
 	yOff = 35
 	xOff = 0
 	NewLine = False
-	for skyIter in condition["skyConditions"]:
-		draw.text((x + xOff, top + yOff), skyIter["cover"] + ("@" + str(skyIter["cloudBaseFt"]) if skyIter["cloudBaseFt"] > 0 else ""), font=fontSmall, fill=255)
+	for skyCondition in skyConditions:
+		draw.text((x + xOff, top + yOff), skyCondition, font=fontSmall, fill=255)
 		if NewLine:
 			yOff += 10
 			xOff = 0
@@ -72,5 +91,26 @@ def outputMetar(disp, station, condition):
 		else:
 			xOff = 64
 			NewLine = True
+	return image
+
+def outputMetar(disp, station, condition):
+	global shownFrame
+	if noDisplayLibraries:
+		return
+
+	if fontLarge is None:
+		loadFonts()
+	# Only render the station again if anything it shows has changed
+	lines = metarLines(station, condition)
+	cached = frameCache.get(station)
+	if cached is None or cached[0] != lines:
+		image = renderMetar(disp.width, disp.height, lines)
+		cached = (lines, image, image.tobytes())
+		frameCache[station] = cached
+	lines, image, frame = cached
+	# Skip the I2C transfer if this image is already on the display
+	if frame == shownFrame:
+		return
 	disp.image(image)
-	disp.show()
\ No newline at end of file
+	disp.show()
+	shownFrame = frame
@@ -0,0 +1,115 @@
+from concurrent.futures import ThreadPoolExecutor
+from lazyimport import lazyImport
+numpy = lazyImport("numpy")
+
+# Sits between the color logic in metar.py and the NeoPixel strip.
+# Every frame is collected in a plain list (or a numpy array of RGB rows) first and only the pixels
+# that changed since the last frame are copied to the strip. show(), which has to clock out the whole
+# strip over GPIO with interrupts disabled, is skipped completely if nothing changed.
+
+class FrameBuffer:
+    """Drop-in replacement for the pixels of a NeoPixel strip with auto_write = False"""
+
+    def __init__(self, pixels):
+        self.pixels = pixels
+        self.frame = [(0, 0, 0)] * len(pixels)
+        self.shown = None
+        self.framesRendered = 0
+        self.framesSkipped = 0
+
+    def __len__(self):
+        return len(self.frame)
+
+    def __getitem__(self, index):
+        return self.frame[index]
+
+    def __setitem__(self, index, color):
+        self.frame[index] = color
+
+    def setFrame(self, colors):
+        """Replace the whole frame, colors holds one color per LED"""
+        if numpy is not None and isinstance(colors, numpy.ndarray):
+            self.frame = colors
+        else:
+            self.frame = list(colors) + self.frame[len(colors):]
+
+    def fill(self, color):
+        self.frame = [tuple(color)] * len(self.frame)
+
+    def invalidate(self):
+        """Force the next show() to write to the strip, e.g. after changing the strip's brightness"""
+        self.shown = None
+
+    def show(self):
+        """Write the frame to the strip if it differs from the last one shown, returns True if it was written"""
+        self.framesRendered += 1
+        if numpy is not None and isinstance(self.frame, numpy.ndarray):
+            return self.showArray()
+        if self.frame == self.shown:
+            self.framesSkipped += 1
+            return False
+        if self.shown is None or len(self.shown) != len(self.frame):
+            self.pixels[:] = self.frame
+        else:
+            pixels = self.pixels
+            for i, (color, shownColor) in enumerate(zip(self.frame, self.shown)):
+                if color != shownColor:
+                    pixels[i] = color
+        self.pixels.show()
+        self.shown = list(self.frame)
+        return True
+
+    def showArray(self):
+        frame = self.frame
+        shown = self.shown
+        if isinstance(shown, numpy.ndarray) and shown.shape == frame.shape:
+            changed = numpy.flatnonzero((frame != shown).any(axis=1))
+            if len(changed) == 0:
+                self.framesSkipped += 1
+                return False
+            pixels = self.pixels
+            for i, color in zip(changed.tolist(), frame[changed].tolist()):
+                pixels[i] = color
+        else:
+            # Write the whole frame in one bulk assignment
+            self.pixels[:len(frame)] = frame.tolist()
+        self.pixels.show()
+        self.shown = frame.copy()
+        return True
+
+class StripGroup:
+    """Several strips shown as one long frame, every strip gets its own slice of the frame
+
+    Each strip has its own FrameBuffer, so an unchanged strip is not written to,
+    and the strips that changed are written in parallel.
+    """
+
+    def __init__(self, strips):
+        self.buffers = [FrameBuffer(strip) for strip in strips]
+        self.executor = ThreadPoolExecutor(max_workers = len(strips)) if len(strips) > 1 else None
+        self.framesRendered = 0
+        self.framesSkipped = 0
+
+    def __len__(self):
+        return sum(len(buffer) for buffer in self.buffers)
+
+    def setFrame(self, colors):
+        start = 0
+        for buffer in self.buffers:
+            buffer.setFrame(colors[start:start + len(buffer)])
+            start += len(buffer)
+
+    def invalidate(self):
+        for buffer in self.buffers:
+            buffer.invalidate()
+
+    def show(self):
+        """Write every changed strip, returns True if any strip was written"""
+        self.framesRendered += 1
+        if self.executor is not None:
+            written = any(list(self.executor.map(FrameBuffer.show, self.buffers)))
+        else:
+            written = any([buffer.show() for buffer in self.buffers])
+        if not written:
+            self.framesSkipped += 1
+        return written
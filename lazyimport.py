@@ -0,0 +1,25 @@
+import sys
+import importlib.util
+
+# Most of the start-up time of metar.py on a Pi Zero goes into importing modules, numpy alone takes seconds.
+# A module imported with lazyImport() is only executed when one of its attributes is used for the first time,
+# so the cached frame is on the LEDs before numpy is loaded, and disabled features never load their modules.
+# The first use has to happen on the main thread, a module that is still being loaded is not safe to share between threads.
+
+def lazyImport(name):
+    """The module name, executed on first use, or None if it is not installed"""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    try:
+        spec = importlib.util.find_spec(name)
+    except (ImportError, ValueError):
+        return None
+    if spec is None:
+        return None
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -1,22 +1,36 @@
 #!/usr/bin/env python3
 
-import urllib.request
+import io
+import os
+import sys
+import json
+import struct
+import operator
+import logging
 import xml.etree.ElementTree as ET
 import board
 import neopixel
 import time
-from time import sleep
-from datetime import datetime, timedelta, time
+from time import sleep, monotonic, perf_counter, time as time_now
+from datetime import datetime, time
 
 import csv
-try:
-    import astral
-except ImportError:
-    astral = None
-try:
-    import displaymetar
-except ImportError:
-    displaymetar = None
+import calendar
+import framebuffer
+import animation
+import suntimes as suntimesCalc
+import stationstate
+import stagetimer
+import spatialindex
+from lazyimport import lazyImport
+# Loaded on first use, so the cached frame is shown before them and disabled features don't load them at all
+astral = lazyImport("astral")
+metarfetch = lazyImport("metarfetch")
+statusserver = lazyImport("statusserver")
+metarlog = lazyImport("metarlog")
+cProfile = lazyImport("cProfile")
+numpy = lazyImport("numpy")
+displaymetar = lazyImport("displaymetar")
 
 # metar.py script iteration 1.5.1
 
@@ -29,6 +43,11 @@ LED_COUNT        = 150            # Number of LED pixels.
 LED_PIN          = board.D18      # GPIO pin connected to the pixels (18 is PCM).
 LED_BRIGHTNESS   = 1.0            # Float from 0.0 (min) to 1.0 (max)
 LED_ORDER        = neopixel.GRB   # Strip type and colour ordering
+# To drive several LED strips from one map, list them here as ("name", GPIO pin, number of LEDs) and
+# add a "strip" column to airports.csv with the name of the strip every airport is on, e.g.
+# LED_STRIPS = [("east", board.D18, 150), ("west", board.D21, 100)]
+# LED_PIN and LED_COUNT are ignored then, the legend is shown on the last strip
+LED_STRIPS       = []
 
 COLOR_VFR        = (255,0,0)      # Green
 COLOR_VFR_FADE   = (125,0,0)      # Green Fade for wind
@@ -58,6 +77,10 @@ BLINK_SPEED                      = 1.0              # Float in seconds, e.g. 0.5
 # Total blinking time in seconds.
 # For example set this to 300 to keep blinking for 5 minutes if you plan to run the script every 5 minutes to fetch the updated weather
 BLINK_TOTALTIME_SECONDS          = 300
+# Smooth animation
+ANIMATION_FPS                    = 30               # Frames per second of the blinking/fading, one full blink/fade takes 2 x BLINK_SPEED. Use 1.0 / BLINK_SPEED for a plain two step blink
+ANIMATION_GAMMA                  = 2.2              # Gamma used to fade evenly between two colors, 1.0 fades linearly
+ANIMATION_PHASE_OFFSETS          = True             # Set to False if all airports should blink/fade in sync
 
 # ----- Daytime dimming of LEDs based on time of day or Sunset/Sunrise -----
 ACTIVATE_DAYTIME_DIMMING         = False             # Set to True if you want to dim the map after a certain time of day
@@ -75,6 +98,43 @@ CONTINUOUS_BRIGHTNESS            = True             # If set to True, brightness
 ACTIVATE_EXTERNAL_METAR_DISPLAY  = False            # Set to True if you want to display METAR conditions to a small external display
 DISPLAY_ROTATION_SPEED           = 5.0              # Float in seconds, e.g 2.0 for two seconds
 
+# ----- Daemon mode -----
+# Keep metar.py running and refresh the weather in-process instead of having refresh.sh restart the script every cycle
+# The daemon keeps running until the stop_refresh file created by lightsoff.sh appears
+RUN_AS_DAEMON                    = False            # Set to True to keep the strip, airports and suntimes loaded between refreshes
+
+# ----- Weather fetching -----
+# The weather is fetched in the background, so the LEDs keep animating while aviationweather.gov is slow or unreachable
+METAR_REFRESH_SECONDS            = 300              # Seconds between weather refreshes
+METAR_FETCH_TIMEOUT              = 30               # Seconds to wait for aviationweather.gov before a request is given up
+METAR_FETCH_RETRIES              = 3                # Number of retries for a failed request
+METAR_RETRY_BACKOFF              = 5.0              # Seconds to wait before the first retry, doubled for every further retry
+METAR_MAX_AGE_SECONDS            = 1800             # Clear the map if the weather could not be refreshed for this many seconds, set to -1 to always show the last known weather
+METAR_HOURS_BEFORE_NOW           = 5                # Hours of METARs to request, only the newest report per airport is used
+METAR_CACHE_FILE                 = "metarcache.xml" # Last response is kept here to show the map right away after a restart and to only download changed weather, set to None to disable
+FRAME_CACHE_FILE                 = "metarframe.json" # Last colors of the LEDs, shown first thing after a restart while the rest is still loading, set to None to disable
+METAR_SHARD_SIZE                 = 100              # Airports per request, larger maps are fetched in several requests, set to 0 to always use a single request
+METAR_FETCH_CONNECTIONS          = 4                # Number of requests made at the same time over kept-alive connections
+
+# ----- Weather history -----
+METAR_LOG_FILE                   = None             # Record the weather to this file for replays, e.g. "/home/pi/METARMap/metarlog.bin", None to disable
+REPLAY_FROM                      = None             # Replay the weather recorded in METAR_LOG_FILE from this local time instead of fetching it, e.g. "2024-05-01 06:00"
+REPLAY_SPEED                     = 60               # How many times faster than in reality the recorded weather is replayed
+
+# ----- Status page and logging -----
+STATUS_PORT                      = None             # Port of the JSON status page, e.g. 8080 for http://<pi address>:8080/, None to disable
+STATUS_HOST                      = "127.0.0.1"      # Address to serve the status page on, "127.0.0.1" for the Pi only or "" for all network interfaces
+LOG_LEVEL                        = "INFO"           # "DEBUG" also logs every station and LED, "WARNING" only logs problems
+LOG_REPEAT_SECONDS               = 60               # An identical message is logged at most once in this many seconds, set to 0 to log every message
+TIMING_LOG_SECONDS               = 300              # Log how long every stage of a frame takes this often, set to 0 to only show it on the status page
+TIMING_WINDOW                    = 1000             # Number of recent samples per stage the timing percentiles are calculated from
+PROFILE_FILE                     = None             # Profile the main loop with cProfile and save the result to this file on exit or when unset again, e.g. "/home/pi/METARMap/metar.prof"
+
+# ----- Fill LEDs without weather from nearby airports -----
+# Uses the lat/lon columns of airports.csv, NULL LEDs are only filled if they have a lat/lon other than 0,0
+INTERPOLATE_MISSING              = False            # Set to True to show the flight category of the nearest reporting airport on LEDs without a METAR of their own
+INTERPOLATION_RADIUS_NM          = 50               # Only airports within this many nautical miles are used to fill an LED
+
 # ----- Show a set of Legend LEDS at the end -----
 SHOW_LEGEND = False            # Set to true if you want to have a set of LEDs at the end show the legend
 # You'll need to add 7 LEDs at the end of your string of LEDs
@@ -90,301 +150,1039 @@ OFFSET_LEGEND_BY = 0
 #    WINDY
 #    HIGH WINDS
 
+# ----- Files -----
+AIRPORTS_FILE                    = "/home/pi/METARMap/airports.csv"    # List of airports in the order of the LEDs
+DISPLAY_AIRPORTS_FILE            = "/home/pi/METARMap/displayairports" # Optional subset of airports to rotate through on the external display
+CONFIG_FILE                      = "/home/pi/METARMap/metarconfig.json" # Optional settings that override the ones above, reloaded while metar.py is running
+
 
 # ---------------------------------------------------------------------------
 # ------------END OF CONFIGURATION-------------------------------------------
 # ---------------------------------------------------------------------------
 
-print("Running metar.py at " + datetime.now().strftime('%d/%m/%Y %H:%M'))
+# Every setting above can also be set in CONFIG_FILE
+CONFIG_SETTINGS = [name for name in list(globals()) if name.isupper() and name != "CONFIG_FILE"]
+# Settings that are only read on start-up, changing them in CONFIG_FILE takes effect after the next restart
+RESTART_SETTINGS = {"LED_COUNT", "LED_PIN", "LED_ORDER", "LED_STRIPS", "RUN_AS_DAEMON", "ACTIVATE_EXTERNAL_METAR_DISPLAY",
+    "METAR_HOURS_BEFORE_NOW", "METAR_CACHE_FILE", "METAR_SHARD_SIZE", "METAR_FETCH_CONNECTIONS", "METAR_LOG_FILE", "REPLAY_FROM", "REPLAY_SPEED", "TIMING_WINDOW", "STATUS_PORT", "STATUS_HOST", "AIRPORTS_FILE", "DISPLAY_AIRPORTS_FILE"}
+
+# Settings that can be set to null in CONFIG_FILE to disable what they configure
+OPTIONAL_SETTINGS = {"STATUS_PORT", "METAR_CACHE_FILE", "FRAME_CACHE_FILE", "METAR_LOG_FILE", "REPLAY_FROM", "PROFILE_FILE"}
+# Allowed ranges of numeric settings, anything outside of them would stop the animation or the fetching
+POSITIVE_SETTINGS = {"LED_COUNT", "BLINK_SPEED", "BLINK_TOTALTIME_SECONDS", "ANIMATION_FPS", "ANIMATION_GAMMA", "DISPLAY_ROTATION_SPEED",
+    "METAR_REFRESH_SECONDS", "METAR_FETCH_TIMEOUT", "METAR_FETCH_CONNECTIONS", "METAR_HOURS_BEFORE_NOW", "REPLAY_SPEED", "TIMING_WINDOW"}
+NON_NEGATIVE_SETTINGS = {"WIND_BLINK_THRESHOLD", "METAR_FETCH_RETRIES", "METAR_RETRY_BACKOFF", "METAR_SHARD_SIZE", "LOG_REPEAT_SECONDS",
+    "TIMING_LOG_SECONDS", "INTERPOLATION_RADIUS_NM", "OFFSET_LEGEND_BY"}
+FRACTION_SETTINGS = {"LED_BRIGHTNESS", "LED_BRIGHTNESS_DIM", "LED_BRIGHTNESS_DARK"}
+# Numeric settings that count something and have to be whole numbers, every other number may have a fraction
+COUNT_SETTINGS = {"LED_COUNT", "METAR_SHARD_SIZE", "METAR_FETCH_CONNECTIONS", "METAR_FETCH_RETRIES", "METAR_HOURS_BEFORE_NOW",
+    "TIMING_WINDOW", "OFFSET_LEGEND_BY"}
+
+# File that on.sh/lightsoff.sh use to signal that the map should stop refreshing
+STOP_FILE = "stop_refresh"
 
-# Figure out sunrise/sunset times if astral is being used
-if astral is not None and USE_SUNRISE_SUNSET:
+log = logging.getLogger("metar")
+
+class RepeatFilter(logging.Filter):
+    """Drops messages that were already logged within the last interval seconds and counts them"""
+
+    def __init__(self, interval):
+        super().__init__()
+        self.interval = interval
+        self.lastLogged = {}
+
+    def filter(self, record):
+        if self.interval <= 0:
+            return True
+        message = record.getMessage()
+        now = monotonic()
+        last = self.lastLogged.get(message)
+        if last is not None and now - last[0] < self.interval:
+            self.lastLogged[message] = (last[0], last[1] + 1)
+            return False
+        if last is not None and last[1] > 0:
+            record.msg = message + " (repeated " + str(last[1]) + " times)"
+            record.args = ()
+        self.lastLogged[message] = (now, 0)
+        # Forget old messages, so distinct messages don't pile up over a long run
+        if len(self.lastLogged) > 1000:
+            self.lastLogged = {key: value for key, value in self.lastLogged.items() if now - value[0] < self.interval}
+        return True
+
+def setupLogging():
+    """Log to stdout with timestamps, at LOG_LEVEL and without repeating identical messages"""
+    logger = logging.getLogger("metar")
+    logger.setLevel(LOG_LEVEL)
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+        handler.addFilter(RepeatFilter(LOG_REPEAT_SECONDS))
+        logger.addHandler(handler)
+        logger.propagate = False
+    for handler in logger.handlers:
+        for logFilter in handler.filters:
+            if isinstance(logFilter, RepeatFilter):
+                logFilter.interval = LOG_REPEAT_SECONDS
+
+def getConfigMtime():
     try:
-        # For older clients running python 3.5 which are using Astral 1.10.1
-        ast = astral.Astral()
-        try:
-            city = ast[LOCATION]
-        except KeyError:
-            print("Error: Location not recognized, please check list of supported cities and reconfigure")
-        else:
-            print(city)
-            sun = city.sun(date = datetime.now().date(), local = True)
-            BRIGHT_TIME_START = sun['sunrise'].time()
-            DIM_TIME_START = sun['sunset'].time()
-    except AttributeError:
-        # newer Raspberry Pi versions using Python 3.6+ using Astral 2.2
-        import astral.geocoder
-        import astral.sun
-        try:
-            city = astral.geocoder.lookup(LOCATION, astral.geocoder.database())
-        except KeyError:
-            print("Error: Location not recognized, please check list of supported cities and reconfigure")
-        else:
-            print(city)
-            sun = astral.sun.sun(city.observer, date = datetime.now().date(), tzinfo=city.timezone)
-            BRIGHT_TIME_START = sun['sunrise'].time()
-            DIM_TIME_START = sun['sunset'].time()
-    print("Sunrise:" + BRIGHT_TIME_START.strftime('%H:%M') + " Sunset:" + DIM_TIME_START.strftime('%H:%M'))
-
-# Initialize the LED strip
-bright = BRIGHT_TIME_START < datetime.now().time() < DIM_TIME_START
-print("Wind animation:" + str(ACTIVATE_WINDCONDITION_ANIMATION))
-print("Lightning animation:" + str(ACTIVATE_LIGHTNING_ANIMATION))
-print("Daytime Dimming:" + str(ACTIVATE_DAYTIME_DIMMING) + (" using Sunrise/Sunset" if USE_SUNRISE_SUNSET and ACTIVATE_DAYTIME_DIMMING else ""))
-print("External Display:" + str(ACTIVATE_EXTERNAL_METAR_DISPLAY))
-pixels = neopixel.NeoPixel(LED_PIN, LED_COUNT, brightness = LED_BRIGHTNESS_DARK if (ACTIVATE_DAYTIME_DIMMING and bright == False) else LED_BRIGHTNESS, pixel_order = LED_ORDER, auto_write = False)
-
-# Read the airports file to retrieve list of airports and use as order for LEDs
-with open("/home/pi/METARMap/airports.csv", newline='') as f:
-    reader = csv.DictReader(f)
-    airports = [row['code'] for row in reader]
-try:
-    with open("/home/pi/METARMap/displayairports") as f2:
-        displayairports = f2.readlines()
-    displayairports = [x.strip() for x in displayairports]
-    print("Using subset airports for LED display")
-except IOError:
-    print("Rotating through all airports on LED display")
-    displayairports = None
-
-# Retrieve METAR from aviationweather.gov data server
-# Details about parameters can be found here: https://www.aviationweather.gov/dataserver/example?datatype=metar
-hoursBeforeNow = 5
-url = "https://aviationweather.gov/cgi-bin/data/metar.php?url_options&ids=" + ",".join([item for item in airports if item != "NULL"]) + "&format=xml&hours=" + str(hoursBeforeNow) + "&order=-obs"
-print(url)
-req = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/86.0.4240.198 Safari/537.36 Edg/86.0.622.69'})
-content = urllib.request.urlopen(req).read()
-
-# Retrieve flying conditions from the service response and store in a dictionary for each airport
-root = ET.fromstring(content)
-conditionDict = { "NULL": {"flightCategory" : "", "windDir": "", "windSpeed" : 0, "windGustSpeed" :  0, "windGust" : False, "lightning": False, "tempC" : 0, "dewpointC" : 0, "vis" : 0, "altimHg" : 0, "obs" : "", "skyConditions" : {}, "obsTime" : datetime.now() } }
-conditionDict.pop("NULL")
-stationList = []
-for metar in root.iter('METAR'):
-    stationId = metar.find('station_id').text
-    if metar.find('flight_category') is None:
-        print("Missing flight condition, skipping.")
-        continue
-    flightCategory = metar.find('flight_category').text
-    windDir = ""
-    windSpeed = 0
-    windGustSpeed = 0
-    windGust = False
-    lightning = False
-    tempC = 0
-    dewpointC = 0
-    vis = 0
-    altimHg = 0.0
-    obs = ""
-    skyConditions = []
-    if metar.find('wind_gust_kt') is not None:
-        windGustSpeed = int(metar.find('wind_gust_kt').text)
-        windGust = (True if (ALWAYS_BLINK_FOR_GUSTS or windGustSpeed > WIND_BLINK_THRESHOLD) else False)
-    if metar.find('wind_speed_kt') is not None:
-        windSpeed = int(metar.find('wind_speed_kt').text)
-    if metar.find('wind_dir_degrees') is not None:
-        windDir = metar.find('wind_dir_degrees').text
-    if metar.find('temp_c') is not None:
-        tempC = int(round(float(metar.find('temp_c').text)))
-    if metar.find('dewpoint_c') is not None:
-        dewpointC = int(round(float(metar.find('dewpoint_c').text)))
-    if metar.find('visibility_statute_mi') is not None:
-        vis = int(round(float(metar.find('visibility_statute_mi').text.replace('+', ''))))
-    if metar.find('altim_in_hg') is not None:
-        altimHg = float(round(float(metar.find('altim_in_hg').text), 2))
-    if metar.find('wx_string') is not None:
-        obs = metar.find('wx_string').text
-    if metar.find('observation_time') is not None:
-        obsTime = datetime.fromisoformat(metar.find('observation_time').text.replace("Z","+00:00"))
-    for skyIter in metar.iter("sky_condition"):
-        skyCond = { "cover" : skyIter.get("sky_cover"), "cloudBaseFt": int(skyIter.get("cloud_base_ft_agl", default=0)) }
-        skyConditions.append(skyCond)
-    if metar.find('raw_text') is not None:
-        rawText = metar.find('raw_text').text
-        lightning = False if ((rawText.find('LTG', 4) == -1 and rawText.find('TS', 4) == -1) or rawText.find('TSNO', 4) != -1) else True
-    print(stationId + ":" 
-    + str(flightCategory if flightCategory is not None else "") + ":" 
-    + (str(windDir) if windDir is not None else "") + "@" + str(windSpeed) + ("G" + str(windGustSpeed) if windGust else "") + ":"
-    + str(vis) + "SM:"
-    + (str(obs) if obs is not None else "") + ":"
-    + str(tempC) + "/"
-    + str(dewpointC) + ":"
-    + str(altimHg) + ":"
-    + ("True" if lightning else "False"))
-    conditionDict[stationId] = { "flightCategory" : flightCategory, "windDir": windDir, "windSpeed" : windSpeed, "windGustSpeed": windGustSpeed, "windGust": windGust, "vis": vis, "obs" : obs, "tempC" : tempC, "dewpointC" : dewpointC, "altimHg" : altimHg, "lightning": lightning, "skyConditions" : skyConditions, "obsTime": obsTime }
-    if displayairports is None or stationId in displayairports:
-        stationList.append(stationId)
-
-# Read data from 'suntimes.csv' file
-with open('suntimes.csv', newline='') as f:
-    reader = csv.DictReader(f)
-    suntimes = {row['code']: row for row in reader}
-
-# Update dictionaries in 'conditionDict' with data from 'suntimes.csv'
-for stationId, conditions in conditionDict.items():
-    if stationId in suntimes:
-        conditions.update({
-            'twilight_start': suntimes[stationId]['twilight_start'],
-            'sunrise': suntimes[stationId]['sunrise'],
-            'sunset': suntimes[stationId]['sunset'],
-            'twilight_end': suntimes[stationId]['twilight_end']
-        })
-
-# Start up external display output
-disp = None
-if displaymetar is not None and ACTIVATE_EXTERNAL_METAR_DISPLAY:
-    print("setting up external display")
-    disp = displaymetar.startDisplay()
-    displaymetar.clearScreen(disp)
-
-# Setting LED colors based on weather conditions
-looplimit = int(round(BLINK_TOTALTIME_SECONDS / BLINK_SPEED)) if (ACTIVATE_WINDCONDITION_ANIMATION or ACTIVATE_LIGHTNING_ANIMATION or ACTIVATE_EXTERNAL_METAR_DISPLAY) else 1
-
-windCycle = False
-displayTime = 0.0
-displayAirportCounter = 0
-numAirports = len(stationList)
-while looplimit > 0:
-    i = 0
-    for airportcode in airports:
-        # Skip NULL entries
-        if airportcode == "NULL":
-            i += 1
+        return os.path.getmtime(CONFIG_FILE)
+    except OSError:
+        return None
+
+def convertSetting(name, value):
+    """Convert a value from the JSON config file to the type of the setting in this script"""
+    current = globals()[name]
+    if value is None and name in OPTIONAL_SETTINGS:
+        return None
+    if name == "LED_PIN":
+        return getattr(board, value)
+    if name == "LED_ORDER":
+        return getattr(neopixel, value)
+    if name == "LED_STRIPS":
+        strips = [(stripName, getattr(board, pin), int(count)) for stripName, pin, count in value]
+        if any(count <= 0 for stripName, pin, count in strips):
+            raise ValueError("every strip needs at least one LED")
+        return strips
+    if name == "LOG_LEVEL":
+        if not isinstance(value, str) or not isinstance(logging.getLevelName(value.upper()), int):
+            raise ValueError("expected one of DEBUG, INFO, WARNING, ERROR or CRITICAL")
+        return value.upper()
+    if name == "STATUS_PORT":
+        if isinstance(value, bool) or not isinstance(value, int) or not 0 <= value <= 65535:
+            raise ValueError("expected a port number or null")
+        return value
+    if name == "REPLAY_FROM":
+        if not isinstance(value, str):
+            raise ValueError("expected a time as YYYY-MM-DD HH:MM or null")
+        datetime.strptime(value, "%Y-%m-%d %H:%M")
+        return value
+    if name in OPTIONAL_SETTINGS and not isinstance(value, str):
+        raise ValueError("expected a string or null")
+    if isinstance(current, bool):
+        if not isinstance(value, bool):
+            raise ValueError("expected true or false")
+        return value
+    if isinstance(current, tuple):
+        # Colors
+        if not isinstance(value, list) or len(value) != 3 or not all(isinstance(component, int) and 0 <= component <= 255 for component in value):
+            raise ValueError("expected three numbers from 0 to 255")
+        return tuple(value)
+    if isinstance(current, time):
+        return time(*[int(part) for part in value.split(":")])
+    if isinstance(current, (int, float)):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError("expected a number")
+        if name in COUNT_SETTINGS:
+            if value != int(value):
+                raise ValueError("expected a whole number")
+            value = int(value)
+        elif isinstance(current, float):
+            value = float(value)
+        if name in POSITIVE_SETTINGS and value <= 0:
+            raise ValueError("expected a number greater than 0")
+        if name in NON_NEGATIVE_SETTINGS and value < 0:
+            raise ValueError("expected a number of at least 0")
+        if name in FRACTION_SETTINGS and not 0 <= value <= 1:
+            raise ValueError("expected a number from 0.0 to 1.0")
+        return value
+    if isinstance(current, str) and not isinstance(value, str):
+        raise ValueError("expected a string")
+    return value
+
+def loadConfig():
+    """Settings from CONFIG_FILE converted to the types used here, or None if the file could not be read"""
+    try:
+        with open(CONFIG_FILE) as f:
+            values = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        log.error("Error reading " + CONFIG_FILE + ", keeping the current settings: " + str(e))
+        return None
+    if not isinstance(values, dict):
+        log.error("Error reading " + CONFIG_FILE + ", expected an object with settings")
+        return None
+    settings = {}
+    for name, value in values.items():
+        if name not in CONFIG_SETTINGS:
+            log.warning("Unknown setting " + name + " in " + CONFIG_FILE + ", ignoring")
             continue
+        try:
+            settings[name] = convertSetting(name, value)
+        except (TypeError, ValueError, AttributeError) as e:
+            log.warning("Invalid value for " + name + " in " + CONFIG_FILE + ", ignoring: " + str(e))
+    return settings
 
-        color = COLOR_CLEAR
-        conditions = conditionDict.get(airportcode, None)
-        windy = False
-        highWinds = False
-        lightningConditions = False
+def applyConfig(settings, defaults, startup):
+    """Set every setting to its value in settings or its default, returns the names of the settings that changed
 
-        brightness_adjustment = 1.0
-        current_utc_datetime = datetime.utcnow()
-        today = datetime.now().date()
+    Settings in RESTART_SETTINGS are only changed on start-up.
+    """
+    changed = set()
+    for name in CONFIG_SETTINGS:
+        value = settings.get(name, defaults[name])
+        if globals()[name] == value:
+            continue
+        if not startup and name in RESTART_SETTINGS:
+            log.warning(name + " changed in " + CONFIG_FILE + ", restart metar.py to apply it")
+            continue
+        globals()[name] = value
+        changed.add(name)
+    return changed
 
+def getDimmingTimes():
+    """Return the (bright, dim) start times, using sunrise/sunset from astral if configured"""
+    brightTimeStart = BRIGHT_TIME_START
+    dimTimeStart = DIM_TIME_START
+    # Figure out sunrise/sunset times if astral is being used
+    if astral is not None and USE_SUNRISE_SUNSET:
         try:
-            t1 = datetime.strptime(conditions['twilight_start'], '%H:%M:%S').time()
-            t2 = datetime.strptime(conditions['sunrise'], '%H:%M:%S').time()
-            t3 = datetime.strptime(conditions['sunset'], '%H:%M:%S').time()
-            t4 = datetime.strptime(conditions['twilight_end'], '%H:%M:%S').time()
-            # Convert t1, t2, t3, and t4 to datetime objects with today's date
-            t1 = datetime.combine(today, t1)
-            t2 = datetime.combine(today, t2)
-            t3 = datetime.combine(today, t3)
-            t4 = datetime.combine(today, t4)
-            # print("current time    -", t)
-            # print("twilight starts -", t1)
-            # print("sunrise         -", t2)
-            # print("sunset          -", t3)
-            # print("twilight ends   -", t4)
-            # Adjust t2, t3, and t4 if they're earlier than the previous time
-            if t2 < t1:
-                t2 += timedelta(days=1)
-            if t3 < t2:
-                t3 += timedelta(days=1)
-            if t4 < t3:
-                t4 += timedelta(days=1)
-        except:
-            brightness_adjustment = 1
-
-        # print(i, current_utc_time, t1, t2, t3, t4)
-
-        t = current_utc_datetime
-
-        # print("after adjustments to the date -")
-        # print("current time    -", t)
-        # print("twilight starts -", t1)
-        # print("sunrise         -", t2)
-        # print("sunset          -", t3)
-        # print("twilight ends   -", t4)
-
-        if conditions != None:
-            # Check the position of t relative to t1, t2, t3, and t4
-            if t < t1:
-                brightness_adjustment = LED_BRIGHTNESS_DARK
-            elif t1 <= t < t2:
-                if CONTINUOUS_BRIGHTNESS:
-                    t21 = (t2-t1).total_seconds()
-                    dt = (t-t1).total_seconds()
-                    d_brightness = LED_BRIGHTNESS_DIM - LED_BRIGHTNESS_DARK
-                    brightness_adjustment = LED_BRIGHTNESS_DARK + d_brightness * dt / t21
-                else:
-                    brightness_adjustment = LED_BRIGHTNESS_DIM
-            elif t2 <= t < t3:
-                brightness_adjustment = 1.0
-            elif t3 <= t < t4:
-                if CONTINUOUS_BRIGHTNESS:
-                    t43 = (t4-t3).total_seconds()
-                    dt = (t-t3).total_seconds()
-                    d_brightness = LED_BRIGHTNESS_DIM - LED_BRIGHTNESS_DARK
-                    brightness_adjustment = LED_BRIGHTNESS_DIM - d_brightness * dt / t43
-                else:
-                    brightness_adjustment = LED_BRIGHTNESS_DIM
+            # For older clients running python 3.5 which are using Astral 1.10.1
+            ast = astral.Astral()
+            try:
+                city = ast[LOCATION]
+            except KeyError:
+                log.error("Location not recognized, please check list of supported cities and reconfigure")
             else:
-                brightness_adjustment = LED_BRIGHTNESS_DARK
-            windy = True if (ACTIVATE_WINDCONDITION_ANIMATION and windCycle == True and (conditions["windSpeed"] >= WIND_BLINK_THRESHOLD or conditions["windGust"] == True)) else False
-            highWinds = True if (windy and HIGH_WINDS_THRESHOLD != -1 and (conditions["windSpeed"] >= HIGH_WINDS_THRESHOLD or conditions["windGustSpeed"] >= HIGH_WINDS_THRESHOLD)) else False
-            lightningConditions = True if (ACTIVATE_LIGHTNING_ANIMATION and windCycle == False and conditions["lightning"] == True) else False
-            if conditions["flightCategory"] == "VFR":
-                color = COLOR_VFR if not (windy or lightningConditions) else COLOR_LIGHTNING if lightningConditions else COLOR_HIGH_WINDS if highWinds else (COLOR_VFR_FADE if FADE_INSTEAD_OF_BLINK else COLOR_CLEAR) if windy else COLOR_CLEAR
-            elif conditions["flightCategory"] == "MVFR":
-                color = COLOR_MVFR if not (windy or lightningConditions) else COLOR_LIGHTNING if lightningConditions else COLOR_HIGH_WINDS if highWinds else (COLOR_MVFR_FADE if FADE_INSTEAD_OF_BLINK else COLOR_CLEAR) if windy else COLOR_CLEAR
-            elif conditions["flightCategory"] == "IFR":
-                color = COLOR_IFR if not (windy or lightningConditions) else COLOR_LIGHTNING if lightningConditions else COLOR_HIGH_WINDS if highWinds else (COLOR_IFR_FADE if FADE_INSTEAD_OF_BLINK else COLOR_CLEAR) if windy else COLOR_CLEAR
-            elif conditions["flightCategory"] == "LIFR":
-                color = COLOR_LIFR if not (windy or lightningConditions) else COLOR_LIGHTNING if lightningConditions else COLOR_HIGH_WINDS if highWinds else (COLOR_LIFR_FADE if FADE_INSTEAD_OF_BLINK else COLOR_CLEAR) if windy else COLOR_CLEAR
+                log.info(str(city))
+                sun = city.sun(date = datetime.now().date(), local = True)
+                brightTimeStart = sun['sunrise'].time()
+                dimTimeStart = sun['sunset'].time()
+        except AttributeError:
+            # newer Raspberry Pi versions using Python 3.6+ using Astral 2.2
+            from astral import geocoder, sun as astralsun
+            try:
+                city = geocoder.lookup(LOCATION, geocoder.database())
+            except KeyError:
+                log.error("Location not recognized, please check list of supported cities and reconfigure")
             else:
-                color = COLOR_CLEAR
+                log.info(str(city))
+                sun = astralsun.sun(city.observer, date = datetime.now().date(), tzinfo=city.timezone)
+                brightTimeStart = sun['sunrise'].time()
+                dimTimeStart = sun['sunset'].time()
+        log.info("Sunrise:" + brightTimeStart.strftime('%H:%M') + " Sunset:" + dimTimeStart.strftime('%H:%M'))
+    return brightTimeStart, dimTimeStart
+
+def getStripBrightness(brightTimeStart, dimTimeStart):
+    bright = brightTimeStart < datetime.now().time() < dimTimeStart
+    return LED_BRIGHTNESS_DARK if (ACTIVATE_DAYTIME_DIMMING and bright == False) else LED_BRIGHTNESS
+
+def getStripConfig():
+    """(name, pin, LED count) of every LED strip"""
+    return LED_STRIPS if LED_STRIPS else [("default", LED_PIN, LED_COUNT)]
+
+def showCachedFrame(strips):
+    """Show the colors saved by saveFrameCache() on the strips, returns whether there were colors for all their LEDs"""
+    if FRAME_CACHE_FILE is None:
+        return False
+    try:
+        with open(FRAME_CACHE_FILE) as f:
+            cached = json.load(f)
+        brightness, colors = cached["brightness"], cached["colors"]
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        log.warning("Error reading " + FRAME_CACHE_FILE + ": " + str(e))
+        return False
+    if len(colors) != sum(len(strip) for strip in strips):
+        log.info("Not showing " + FRAME_CACHE_FILE + ", it was saved for a different number of LEDs")
+        return False
+    start = 0
+    for strip in strips:
+        strip.brightness = brightness
+        for i in range(len(strip)):
+            strip[i] = tuple(colors[start + i])
+        strip.show()
+        start += len(strip)
+    log.info("Showing the last frame from " + FRAME_CACHE_FILE)
+    return True
+
+def saveFrameCache(colors, brightness):
+    """Save the colors of all LEDs for showCachedFrame() at the next start"""
+    if FRAME_CACHE_FILE is None:
+        return
+    if numpy is not None and isinstance(colors, numpy.ndarray):
+        colors = colors.tolist()
+    try:
+        # Written to a temporary file first so a power cut never leaves half a frame behind
+        with open(FRAME_CACHE_FILE + ".tmp", "w") as f:
+            json.dump({"brightness": brightness, "colors": [list(color) for color in colors]}, f, separators=(",", ":"))
+        os.replace(FRAME_CACHE_FILE + ".tmp", FRAME_CACHE_FILE)
+    except OSError as e:
+        log.error("Error saving the frame to " + FRAME_CACHE_FILE + ": " + str(e))
+
+def loadAirports():
+    """Read the airports file to retrieve list of airports and use as order for LEDs
+
+    With several strips the airports of every strip are lined up one strip after the other,
+    so the LEDs of all strips can be handled as one long strip.
+    Returns the airports, the airports for the external display and the (lat, lon) of every LED.
+    """
+    with open(AIRPORTS_FILE, newline='') as f:
+        reader = csv.DictReader(f)
+        rows = list(reader)
+    if not LED_STRIPS:
+        airports = [row['code'] for row in rows]
+        airportPositions = [getPosition(row) for row in rows]
+    else:
+        airports = []
+        airportPositions = []
+        stripNames = [name for name, pin, count in LED_STRIPS]
+        for row in rows:
+            if row.get('strip') not in stripNames:
+                log.warning("Airport " + row['code'] + " is not assigned to any of the configured strips, skipping")
+        for j, (name, pin, count) in enumerate(LED_STRIPS):
+            stripRows = [row for row in rows if row.get('strip') == name]
+            if len(stripRows) > count:
+                log.warning("Strip " + name + " has more airports than LEDs, skipping the last " + str(len(stripRows) - count))
+            stripRows = stripRows[:count]
+            stripAirports = [row['code'] for row in stripRows]
+            stripPositions = [getPosition(row) for row in stripRows]
+            # Fill up all but the last strip, so the next strip starts at the right LED
+            if j < len(LED_STRIPS) - 1:
+                stripAirports += ["NULL"] * (count - len(stripAirports))
+                stripPositions += [None] * (count - len(stripPositions))
+            airports += stripAirports
+            airportPositions += stripPositions
+    try:
+        with open(DISPLAY_AIRPORTS_FILE) as f2:
+            displayairports = f2.readlines()
+        displayairports = [x.strip() for x in displayairports]
+        log.info("Using subset airports for LED display")
+    except IOError:
+        log.info("Rotating through all airports on LED display")
+        displayairports = None
+    return airports, displayairports, airportPositions
+
+def getPosition(row):
+    """(lat, lon) of a row of the airports file, None if it has none"""
+    try:
+        lat, lon = float(row['lat']), float(row['lon'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    # NULL LEDs are listed at 0,0 when they don't stand for a place on the map
+    if lat == 0 and lon == 0:
+        return None
+    return lat, lon
+
+class StationCondition:
+    """Newest reported conditions of a single airport"""
+    __slots__ = ("stationId", "flightCategory", "windDir", "windSpeed", "windGustSpeed", "windGust", "vis", "obs",
+        "tempC", "dewpointC", "altimHg", "lightning", "skyConditions", "obsTime", "rawText")
+
+    def __init__(self, stationId, flightCategory):
+        self.stationId = stationId
+        self.flightCategory = flightCategory
+        self.windDir = ""
+        self.windSpeed = 0
+        self.windGustSpeed = 0
+        self.windGust = False
+        self.vis = 0
+        self.obs = ""
+        self.tempC = 0
+        self.dewpointC = 0
+        self.altimHg = 0.0
+        self.lightning = False
+        # List of (cover, cloudBaseFt) tuples
+        self.skyConditions = []
+        self.obsTime = None
+        self.rawText = None
+
+    def __eq__(self, other):
+        if not isinstance(other, StationCondition):
+            return False
+        # All other fields are decoded from the raw report, so comparing it is enough and much quicker
+        if self.rawText is not None and other.rawText is not None:
+            return self.rawText == other.rawText and self.flightCategory == other.flightCategory
+        return stationConditionFields(self) == stationConditionFields(other)
+
+    def asDict(self):
+        fields = dict(zip(self.__slots__, stationConditionFields(self)))
+        fields["obsTime"] = self.obsTime.isoformat() if self.obsTime is not None else None
+        return fields
+
+    @classmethod
+    def fromDict(cls, fields):
+        """Reverse of asDict(), fields missing from older records keep their defaults"""
+        condition = cls(fields["stationId"], fields.get("flightCategory"))
+        for name in cls.__slots__:
+            if name in fields:
+                setattr(condition, name, fields[name])
+        condition.skyConditions = [tuple(sky) for sky in condition.skyConditions or []]
+        condition.obsTime = datetime.fromisoformat(condition.obsTime) if condition.obsTime else None
+        return condition
+
+# All fields of a StationCondition as one tuple, for comparing conditions quickly
+stationConditionFields = operator.attrgetter(*StationCondition.__slots__)
+
+def isGustAnimated(windGustSpeed):
+    return True if (ALWAYS_BLINK_FOR_GUSTS or windGustSpeed > WIND_BLINK_THRESHOLD) else False
+
+def parseMetarElement(metar, stationId):
+    """Build the StationCondition of a single METAR element in one pass over its children"""
+    condition = StationCondition(stationId, None)
+    for child in metar:
+        tag = child.tag
+        if tag == 'flight_category':
+            condition.flightCategory = child.text
+        elif tag == 'wind_gust_kt':
+            condition.windGustSpeed = int(child.text)
+            condition.windGust = isGustAnimated(condition.windGustSpeed)
+        elif tag == 'wind_speed_kt':
+            condition.windSpeed = int(child.text)
+        elif tag == 'wind_dir_degrees':
+            condition.windDir = child.text
+        elif tag == 'temp_c':
+            condition.tempC = int(round(float(child.text)))
+        elif tag == 'dewpoint_c':
+            condition.dewpointC = int(round(float(child.text)))
+        elif tag == 'visibility_statute_mi':
+            condition.vis = int(round(float(child.text.replace('+', ''))))
+        elif tag == 'altim_in_hg':
+            condition.altimHg = float(round(float(child.text), 2))
+        elif tag == 'wx_string':
+            condition.obs = child.text
+        elif tag == 'observation_time':
+            condition.obsTime = datetime.fromisoformat(child.text.replace("Z","+00:00"))
+        elif tag == 'sky_condition':
+            condition.skyConditions.append((child.get("sky_cover"), int(child.get("cloud_base_ft_agl", default=0))))
+        elif tag == 'raw_text':
+            condition.rawText = child.text
+    rawText = condition.rawText
+    if rawText is not None:
+        condition.lightning = False if ((rawText.find('LTG', 4) == -1 and rawText.find('TS', 4) == -1) or rawText.find('TSNO', 4) != -1) else True
+    if condition.obsTime is None:
+        condition.obsTime = datetime.now()
+    return condition
+
+def parseMetars(content, displayairports):
+    """Retrieve flying conditions from the service response and store them for each airport
+
+    The response is streamed with iterparse and every METAR element is dropped as soon as it has been read.
+    As the METARs are ordered newest first (order=-obs), only the first report with a flight category is kept per airport.
+    """
+    conditionDict = {}
+    stationList = []
+    data = None
+    for event, elem in ET.iterparse(io.BytesIO(content), events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == 'data':
+                data = elem
+            continue
+        if elem.tag != 'METAR':
+            continue
+        stationId = elem.findtext('station_id')
+        if stationId is not None and stationId not in conditionDict:
+            condition = parseMetarElement(elem, stationId)
+            if condition.flightCategory is None:
+                log.debug("Missing flight condition for " + stationId + ", skipping.")
+            else:
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug(stationId + ":"
+                    + str(condition.flightCategory) + ":"
+                    + (str(condition.windDir) if condition.windDir is not None else "") + "@" + str(condition.windSpeed) + ("G" + str(condition.windGustSpeed) if condition.windGust else "") + ":"
+                    + str(condition.vis) + "SM:"
+                    + (str(condition.obs) if condition.obs is not None else "") + ":"
+                    + str(condition.tempC) + "/"
+                    + str(condition.dewpointC) + ":"
+                    + str(condition.altimHg) + ":"
+                    + ("True" if condition.lightning else "False"))
+                conditionDict[stationId] = condition
+                if displayairports is None or stationId in displayairports:
+                    stationList.append(stationId)
+        # Done with this METAR, free it and everything parsed before it
+        elem.clear()
+        if data is not None:
+            data.clear()
+    return conditionDict, stationList
+
+def loadSuntimes():
+    """Read data from 'suntimes.csv' file"""
+    try:
+        with open('suntimes.csv', newline='') as f:
+            reader = csv.DictReader(f)
+            return {row['code']: row for row in reader}
+    except IOError:
+        log.warning("No suntimes.csv found, LEDs will not be dimmed by local daylight")
+        return {}
+
+class SunSchedule:
+    """Twilight start, sunrise, sunset and twilight end of every LED as UTC epoch seconds
+
+    The times from suntimes.csv are parsed once for a given day, so the brightness of all LEDs
+    can be looked up every frame without any date parsing. LEDs without suntimes stay at full brightness.
+    """
+
+    def __init__(self, airports, suntimes, day, ledCount):
+        self.day = day
+        self.brightnessDim = LED_BRIGHTNESS_DIM
+        self.brightnessDark = LED_BRIGHTNESS_DARK
+        self.continuous = CONTINUOUS_BRIGHTNESS
+        dayStart = calendar.timegm(day.timetuple())
+        twilightStart = []
+        sunrise = []
+        sunset = []
+        twilightEnd = []
+        for airportcode in airports[:ledCount] + ["NULL"] * (ledCount - len(airports)):
+            times = None
+            row = suntimes.get(airportcode)
+            if row is not None and not row.get('sunrise') and not row.get('sunset'):
+                # Polar day, the sun doesn't set and the LED stays at full brightness
+                row = None
+            if row is not None:
+                try:
+                    times = [dayStart + parseSuntime(row[key]) for key in ('twilight_start', 'sunrise', 'sunset', 'twilight_end')]
+                except (KeyError, ValueError, AttributeError):
+                    log.warning("Invalid suntimes for " + airportcode + ", ignoring")
+            if times is not None:
+                # Adjust sunrise, sunset and twilight end if they're earlier than the previous time
+                for j in range(1, 4):
+                    if times[j] < times[j-1]:
+                        times[j] += 86400
+            else:
+                times = [None] * 4
+            twilightStart.append(times[0])
+            sunrise.append(times[1])
+            sunset.append(times[2])
+            twilightEnd.append(times[3])
+        if numpy is not None:
+            # Unknown times become NaN, which never compares as inside any period
+            self.twilightStart, self.sunrise, self.sunset, self.twilightEnd = [numpy.array(times, dtype=float) for times in (twilightStart, sunrise, sunset, twilightEnd)]
+        else:
+            self.twilightStart, self.sunrise, self.sunset, self.twilightEnd = twilightStart, sunrise, sunset, twilightEnd
 
-        print(f"Setting LED {i} for {airportcode or 'Unknown'} to " +
+    def brightness(self, now):
+        """Brightness adjustment of every LED at epoch time now"""
+        dim, dark, continuous = self.brightnessDim, self.brightnessDark, self.continuous
+        dBrightness = dim - dark
+        if numpy is not None:
+            t1, t2, t3, t4 = self.twilightStart, self.sunrise, self.sunset, self.twilightEnd
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                if continuous:
+                    rising = dark + dBrightness * (now - t1) / (t2 - t1)
+                    setting = dim - dBrightness * (now - t3) / (t4 - t3)
+                else:
+                    rising = setting = dim
+                return numpy.select([(now < t1) | (now >= t4), now < t2, now < t3, now < t4],
+                    [dark, rising, 1.0, setting], 1.0)
+        return [1.0 if t1 is None
+            else dark if (now < t1 or now >= t4)
+            else (dark + dBrightness * (now - t1) / (t2 - t1) if continuous else dim) if now < t2
+            else 1.0 if now < t3
+            else (dim - dBrightness * (now - t3) / (t4 - t3) if continuous else dim)
+            for t1, t2, t3, t4 in zip(self.twilightStart, self.sunrise, self.sunset, self.twilightEnd)]
+
+def parseSuntime(value):
+    """Seconds since midnight of a HH:MM:SS suntime"""
+    h, m, s = value.split(':')
+    return int(h) * 3600 + int(m) * 60 + int(s)
+
+def refreshSuntimesIfStale():
+    """Regenerate suntimes.csv if it was not updated today, from the table of the year if there is one, otherwise calculated locally"""
+    try:
+        stale = datetime.fromtimestamp(os.path.getmtime('suntimes.csv')).date() != datetime.now().date()
+    except OSError:
+        stale = True
+    if stale:
+        log.info("Updating suntimes.csv...")
+        try:
+            suntimesCalc.write_suntimes(airports_path = AIRPORTS_FILE)
+        except (IOError, ValueError) as e:
+            log.error("Error updating suntimes.csv: " + str(e))
+
+def getSuntimesMtime():
+    try:
+        return os.path.getmtime('suntimes.csv')
+    except OSError:
+        return None
+
+# Flight categories in the order of their color ramps, index 0 is reserved for LEDs that stay clear
+CATEGORIES = ["VFR", "MVFR", "IFR", "LIFR"]
+
+def buildAnimationRamps(cycleFrames):
+    """Precompute the color ramps of every flight category and kind of animation"""
+    categoryColors = [(COLOR_VFR, COLOR_VFR_FADE), (COLOR_MVFR, COLOR_MVFR_FADE), (COLOR_IFR, COLOR_IFR_FADE), (COLOR_LIFR, COLOR_LIFR_FADE)]
+    ramps = [[COLOR_CLEAR] * cycleFrames]
+    for color, fadeColor in categoryColors:
+        for kind in range(animation.NUM_KINDS):
+            ramps.append(animation.buildRamp(color, fadeColor if FADE_INSTEAD_OF_BLINK else COLOR_CLEAR, COLOR_HIGH_WINDS, COLOR_LIGHTNING,
+                kind, cycleFrames, FADE_INSTEAD_OF_BLINK, ANIMATION_GAMMA))
+    return ramps
+
+def rampIndex(flightCategory, kind):
+    return 1 + CATEGORIES.index(flightCategory) * animation.NUM_KINDS + kind
+
+def getSteadyRamps():
+    """Index of the ramp every ramp rests at, the plain color of its flight category"""
+    return [0] + [rampIndex(flightCategory, animation.KIND_STATIC) for flightCategory in CATEGORIES for kind in range(animation.NUM_KINDS)]
+
+def getLedState(airportcode, conditions):
+    """Ramp index of the LED of one airport, and a description of what it shows"""
+    windy = False
+    highWinds = False
+    lightningConditions = False
+    state = 0
+
+    if conditions != None and conditions.flightCategory in CATEGORIES:
+        windy = True if (ACTIVATE_WINDCONDITION_ANIMATION and (conditions.windSpeed >= WIND_BLINK_THRESHOLD or conditions.windGust == True)) else False
+        highWinds = True if (windy and HIGH_WINDS_THRESHOLD != -1 and (conditions.windSpeed >= HIGH_WINDS_THRESHOLD or conditions.windGustSpeed >= HIGH_WINDS_THRESHOLD)) else False
+        lightningConditions = True if (ACTIVATE_LIGHTNING_ANIMATION and conditions.lightning == True) else False
+        if lightningConditions:
+            kind = animation.KIND_LIGHTNING_HIGH_WINDS if highWinds else animation.KIND_LIGHTNING_WINDY if windy else animation.KIND_LIGHTNING
+        else:
+            kind = animation.KIND_HIGH_WINDS if highWinds else animation.KIND_WINDY if windy else animation.KIND_STATIC
+        state = rampIndex(conditions.flightCategory, kind)
+
+    description = (f"{airportcode or 'Unknown'} to " +
         f"{'lightning ' if lightningConditions else ''}" +
         f"{'very ' if highWinds else ''}" +
         f"{'windy ' if windy else ''}" +
-        f"{conditions.get('flightCategory', 'None') if conditions else 'None'} " +
-        f"{color if color is not None else 'No Color'}")
+        f"{conditions.flightCategory if conditions else 'None'}")
+    return state, description
 
-        print("brightness_adjustment =", brightness_adjustment)
+def hasFlightCategory(conditions):
+    return conditions is not None and conditions.flightCategory in CATEGORIES
 
-        if USE_DYNAMIC_SUNTIME:
-            g, r, b = color
-            g = int(float(g) * brightness_adjustment)
-            r = int(float(r) * brightness_adjustment)
-            b = int(float(b) * brightness_adjustment)
-            pixels[i] = (g, r, b)
-        else:
-            pixels[i] = color
+def getFilledLedState(i, airports, conditionDict, nearestStations):
+    """Like getLedState() for LED i, filled from the nearest reporting airport if it has no flight category of its own"""
+    airportcode = airports[i]
+    conditions = conditionDict.get(airportcode, None)
+    if nearestStations is None or hasFlightCategory(conditions):
+        return getLedState(airportcode, conditions)
+    stationId = nearestStations.nearest(i, lambda stationId: hasFlightCategory(conditionDict.get(stationId, None)))
+    if stationId is None:
+        return getLedState(airportcode, conditions)
+    # The wind and lightning of another airport don't apply here, only its flight category is shown
+    flightCategory = conditionDict[stationId].flightCategory
+    return rampIndex(flightCategory, animation.KIND_STATIC), f"{airportcode} to {flightCategory} of {stationId}"
+
+def getNearestStations(airports, positions):
+    """Airports near every LED if INTERPOLATE_MISSING is on, otherwise None"""
+    if not INTERPOLATE_MISSING:
+        return None
+    nearestStations = spatialindex.NearestStations(airports, positions, INTERPOLATION_RADIUS_NM)
+    log.info(str(len(nearestStations.neighbours)) + " LEDs have airports within " + str(INTERPOLATION_RADIUS_NM) + " nm to fill them from")
+    return nearestStations
+
+def getLedIndex(airports):
+    """LED positions of every airport, an airport may be on the map more than once"""
+    ledIndex = {}
+    for i, airportcode in enumerate(airports):
+        if airportcode != "NULL":
+            ledIndex.setdefault(airportcode, []).append(i)
+    return ledIndex
+
+def getChangedLedStates(airports, ledIndex, conditionDict, changedStations, nearestStations = None):
+    """LED positions and ramp indexes of only the airports whose conditions changed, and the LEDs filled from them"""
+    indices = {i for stationId in changedStations for i in ledIndex.get(stationId, ())}
+    if nearestStations is not None:
+        indices |= nearestStations.affected(changedStations)
+    indices = sorted(indices)
+    states = []
+    for i in indices:
+        state, description = getFilledLedState(i, airports, conditionDict, nearestStations)
+        log.debug("Setting LED %d for %s", i, description)
+        states.append(state)
+    return indices, states
+
+def getLedStates(airports, conditionDict, cycleFrames, ledCount, nearestStations = None):
+    """Ramp index and animation phase of every LED based on weather conditions"""
+    states = [0] * ledCount
+    phases = animation.phaseOffsets(airports, cycleFrames) if ANIMATION_PHASE_OFFSETS else [0] * len(airports)
+    phases += [0] * (ledCount - len(phases))
+    i = 0
+    for airportcode in airports:
+        # Skip NULL entries, unless they can be filled from nearby airports
+        if airportcode == "NULL" and (nearestStations is None or i not in nearestStations.neighbours):
+            i += 1
+            continue
+
+        states[i], description = getFilledLedState(i, airports, conditionDict, nearestStations)
+        log.debug("Setting LED %d for %s", i, description)
         i += 1
 
     # Legend
     if SHOW_LEGEND:
-        pixels[i + OFFSET_LEGEND_BY] = COLOR_VFR
-        pixels[i + OFFSET_LEGEND_BY + 1] = COLOR_MVFR
-        pixels[i + OFFSET_LEGEND_BY + 2] = COLOR_IFR
-        pixels[i + OFFSET_LEGEND_BY + 3] = COLOR_LIFR
-        if ACTIVATE_LIGHTNING_ANIMATION == True:
-            pixels[i + OFFSET_LEGEND_BY + 4] = COLOR_LIGHTNING if windCycle else COLOR_VFR # lightning
-        if ACTIVATE_WINDCONDITION_ANIMATION == True:
-            pixels[i+ OFFSET_LEGEND_BY + 5] = COLOR_VFR if not windCycle else (COLOR_VFR_FADE if FADE_INSTEAD_OF_BLINK else COLOR_CLEAR)    # windy
-            if HIGH_WINDS_THRESHOLD != -1:
-                pixels[i + OFFSET_LEGEND_BY + 6] = COLOR_VFR if not windCycle else COLOR_HIGH_WINDS  # high winds
-
-    # Update actual LEDs all at once
-    pixels.show()
-    
-    # Rotate through airports METAR on external display
-    if disp is not None:
-        if displayTime <= DISPLAY_ROTATION_SPEED:
-            displaymetar.outputMetar(disp, stationList[displayAirportCounter], conditionDict.get(stationList[displayAirportCounter], None))
-            displayTime += BLINK_SPEED
+        legend = [rampIndex("VFR", animation.KIND_STATIC), rampIndex("MVFR", animation.KIND_STATIC), rampIndex("IFR", animation.KIND_STATIC), rampIndex("LIFR", animation.KIND_STATIC),
+            rampIndex("VFR", animation.KIND_LIGHTNING) if ACTIVATE_LIGHTNING_ANIMATION else 0,
+            rampIndex("VFR", animation.KIND_WINDY) if ACTIVATE_WINDCONDITION_ANIMATION else 0,
+            rampIndex("VFR", animation.KIND_HIGH_WINDS) if (ACTIVATE_WINDCONDITION_ANIMATION and HIGH_WINDS_THRESHOLD != -1) else 0]
+        for j, state in enumerate(legend):
+            if i + OFFSET_LEGEND_BY + j < ledCount:
+                states[i + OFFSET_LEGEND_BY + j] = state
+                phases[i + OFFSET_LEGEND_BY + j] = 0
+    return states, phases
+
+class MapStatus:
+    """What the map is showing, collected for the status page
+
+    The main loop only replaces attributes and the status page runs in its own thread,
+    so asDict() always works on complete values and never slows down a frame.
+    """
+
+    def __init__(self, airports, strips, pixels, fetcher, stationStore, stageTimer):
+        self.airports = airports
+        self.strips = strips
+        self.pixels = pixels
+        self.fetcher = fetcher
+        self.stationStore = stationStore
+        self.stageTimer = stageTimer
+        self.startedAt = monotonic()
+        self.colors = None
+        self.brightness = None
+
+    def recordFrame(self, colors, brightness):
+        self.colors = colors
+        self.brightness = brightness
+
+    def asDict(self):
+        snapshot = self.fetcher.snapshot
+        colors = self.colors
+        brightness = self.brightness
+        if numpy is not None and isinstance(colors, numpy.ndarray):
+            colors = colors.tolist()
+        if numpy is not None and isinstance(brightness, numpy.ndarray):
+            brightness = brightness.tolist()
+        leds = []
+        for i, color in enumerate(colors or []):
+            leds.append({
+                "led": i,
+                "airport": self.airports[i] if i < len(self.airports) else None,
+                "color": list(color),
+                "brightness": brightness[i] if brightness is not None else 1.0})
+        return {
+            "uptimeSeconds": round(monotonic() - self.startedAt, 1),
+            "fetch": {
+                "ageSeconds": round(monotonic() - snapshot.fetchedAt, 1) if snapshot is not None else None,
+                "stations": len(snapshot.conditionDict) if snapshot is not None else 0,
+                "replayTime": datetime.fromtimestamp(self.fetcher.replayTime).isoformat() if getattr(self.fetcher, "replayTime", None) else None,
+                "shards": [{
+                    "url": shard.url,
+                    "ageSeconds": round(monotonic() - shard.fetchedAt, 1) if shard.fetchedAt is not None else None}
+                    for shard in self.fetcher.shards]},
+            "conditions": {stationId: condition.asDict() for stationId, condition in self.stationStore.conditionDict.items()},
+            "transitions": [str(event) for event in list(self.stationStore.recentEvents)],
+            "stripBrightness": [strip.brightness for strip in self.strips],
+            "leds": leds,
+            "render": dict(self.stageTimer.asDict(),
+                frames = self.pixels.framesRendered,
+                framesSkipped = self.pixels.framesSkipped)}
+
+def updateStations(stationStore, airports, ledIndex, conditionDict, ledAnimation, nearestStations = None):
+    """Apply new conditions to the LEDs of the stations that changed and report their transitions, returns the changed station ids"""
+    # The first weather after start-up makes every station new, and most stations just send a newer observation every hour,
+    # both are only worth logging when debugging
+    level = logging.INFO if stationStore.conditionDict else logging.DEBUG
+    changedStations, events = stationStore.update(conditionDict)
+    for event in events:
+        log.log(logging.DEBUG if event.kind == stationstate.EVENT_UPDATED else level, "Transition: %s", event)
+    ledAnimation.updateStates(*getChangedLedStates(airports, ledIndex, conditionDict, changedStations, nearestStations))
+    log.info(str(len(changedStations)) + " of " + str(len(conditionDict)) + " stations changed")
+    return changedStations
+
+def buildReplayConditions(state, displayairports):
+    """conditionDict and stationList of the recorded state of all stations"""
+    conditionDict = {}
+    stationList = []
+    for stationId, fields in state.items():
+        condition = StationCondition.fromDict(fields)
+        # Animate gusts according to the current settings, not the ones at the time of recording
+        if condition.windGustSpeed:
+            condition.windGust = isGustAnimated(condition.windGustSpeed)
+        conditionDict[stationId] = condition
+        if displayairports is None or stationId in displayairports:
+            stationList.append(stationId)
+    return conditionDict, stationList
+
+def startProfiler():
+    profiler = cProfile.Profile()
+    profiler.enable()
+    log.info("Profiling the main loop to " + PROFILE_FILE)
+    return profiler
+
+def stopProfiler(profiler, path):
+    profiler.disable()
+    try:
+        profiler.dump_stats(path)
+        log.info("Profile written to " + path + ", show it with: python3 -m pstats " + path)
+    except OSError as e:
+        log.error("Error writing profile to " + path + ": " + str(e))
+
+def buildRenderTables(airports, conditionDict, ledCount, nearestStations = None):
+    """Frame period, frames per BLINK_SPEED tick and the animation with its ramps and LED states for the current settings"""
+    framePeriod = 1.0 / ANIMATION_FPS
+    # One full blink/fade takes two BLINK_SPEED ticks, the weather display and housekeeping run once per tick
+    framesPerTick = max(1, int(round(BLINK_SPEED * ANIMATION_FPS)))
+    cycleFrames = 2 * framesPerTick
+    ledAnimation = animation.Animation(buildAnimationRamps(cycleFrames), ledCount, getSteadyRamps())
+    ledAnimation.setStates(*getLedStates(airports, conditionDict, cycleFrames, ledCount, nearestStations))
+    return framePeriod, framesPerTick, ledAnimation
+
+def main():
+    setupLogging()
+    # The settings in CONFIG_FILE override the ones in this script, which stay the defaults for settings removed from the file
+    configDefaults = {name: globals()[name] for name in CONFIG_SETTINGS}
+    configMtime = getConfigMtime()
+    applyConfig(loadConfig() or {}, configDefaults, True)
+    setupLogging()
+    # Only the main thread is profiled, that is where the frames are rendered
+    profilePath = PROFILE_FILE
+    profiler = startProfiler() if profilePath is not None else None
+    # Durations of every stage of a frame, the fetcher thread adds the fetching and parsing
+    stageTimer = stagetimer.StageTimer(TIMING_WINDOW)
+    log.info("Running metar.py at " + datetime.now().strftime('%d/%m/%Y %H:%M'))
+
+    # Initialize the LED strip and show the last frame of the previous run, before numpy, astral and the weather are loaded
+    strips = [neopixel.NeoPixel(pin, count, brightness = LED_BRIGHTNESS, pixel_order = LED_ORDER, auto_write = False)
+        for name, pin, count in getStripConfig()]
+    showCachedFrame(strips)
+
+    brightTimeStart, dimTimeStart = getDimmingTimes()
+    for strip in strips:
+        strip.brightness = getStripBrightness(brightTimeStart, dimTimeStart)
+    log.info("Wind animation:" + str(ACTIVATE_WINDCONDITION_ANIMATION))
+    log.info("Lightning animation:" + str(ACTIVATE_LIGHTNING_ANIMATION))
+    log.info("Daytime Dimming:" + str(ACTIVATE_DAYTIME_DIMMING) + (" using Sunrise/Sunset" if USE_SUNRISE_SUNSET and ACTIVATE_DAYTIME_DIMMING else ""))
+    log.info("External Display:" + str(ACTIVATE_EXTERNAL_METAR_DISPLAY))
+    log.info("Daemon mode:" + str(RUN_AS_DAEMON))
+    # All strips are rendered as one frame, only changed strips are written to and they are written in parallel
+    pixels = framebuffer.StripGroup(strips)
+    ledCount = len(pixels)
+
+    airports, displayairports, positions = loadAirports()
+    snapshotLog = None
+    if METAR_LOG_FILE is not None:
+        try:
+            snapshotLog = metarlog.SnapshotLog(METAR_LOG_FILE)
+        except (OSError, ValueError, struct.error) as e:
+            log.error("Error opening " + METAR_LOG_FILE + ", not recording the weather: " + str(e))
+    replayStart = None
+    if REPLAY_FROM is not None and snapshotLog is None:
+        log.warning("REPLAY_FROM needs the METAR_LOG_FILE to replay from, fetching the current weather instead")
+    elif REPLAY_FROM is not None:
+        try:
+            replayStart = metarlog.parseTime(REPLAY_FROM)
+        except ValueError:
+            log.warning("REPLAY_FROM has to be a local time as YYYY-MM-DD HH:MM, fetching the current weather instead")
+        if replayStart is not None and not snapshotLog.times:
+            log.warning("No weather recorded in " + METAR_LOG_FILE + " yet, fetching the current weather instead")
+            replayStart = None
+    # A replay only moves on while metar.py keeps running, refresh.sh would start it from REPLAY_FROM again every time
+    runAsDaemon = RUN_AS_DAEMON or replayStart is not None
+    if replayStart is not None:
+        log.info("Replaying the weather recorded in " + METAR_LOG_FILE + " from " + REPLAY_FROM + " at " + str(REPLAY_SPEED) + "x speed")
+        if not RUN_AS_DAEMON:
+            log.info("Running in daemon mode until the replay is stopped with " + STOP_FILE)
+        fetcher = metarlog.ReplayFetcher(snapshotLog, lambda state: buildReplayConditions(state, displayairports), replayStart, REPLAY_SPEED)
+        # Nothing new to record while replaying
+        snapshotLog = None
+    else:
+        fetcher = metarfetch.MetarFetcher(airports, lambda content: parseMetars(content, displayairports), METAR_REFRESH_SECONDS,
+            timeout = METAR_FETCH_TIMEOUT, retries = METAR_FETCH_RETRIES, backoff = METAR_RETRY_BACKOFF,
+            cachePath = METAR_CACHE_FILE, hoursBeforeNow = METAR_HOURS_BEFORE_NOW, shardSize = METAR_SHARD_SIZE,
+            connections = METAR_FETCH_CONNECTIONS, maxAge = METAR_MAX_AGE_SECONDS if METAR_MAX_AGE_SECONDS != -1 else None, stageTimer = stageTimer,
+            refreshOnStart = not runAsDaemon)
+    fetcher.start()
+    snapshot = None
+    conditionDict = {}
+    stationList = []
+    # Only the LEDs of stations whose conditions changed are recalculated for a new snapshot
+    stationStore = stationstate.StationStore()
+    ledIndex = getLedIndex(airports)
+    nearestStations = getNearestStations(airports, positions)
+    mapStatus = MapStatus(airports, strips, pixels, fetcher, stationStore, stageTimer)
+    if USE_DYNAMIC_SUNTIME:
+        refreshSuntimesIfStale()
+    stageStart = perf_counter()
+    suntimes = loadSuntimes()
+    suntimesMtime = getSuntimesMtime()
+    sunSchedule = SunSchedule(airports, suntimes, datetime.now().date(), ledCount)
+    stageTimer.record("suntimes", perf_counter() - stageStart)
+
+    # Start up external display output
+    disp = None
+    if displaymetar is not None and ACTIVATE_EXTERNAL_METAR_DISPLAY:
+        log.info("setting up external display")
+        try:
+            disp = displaymetar.startDisplay()
+            displaymetar.clearScreen(disp)
+        except ImportError as e:
+            log.error("External display not available: " + str(e))
+            disp = None
+
+    # Start from a map without weather, this also sets up the animation phases and the legend
+    framePeriod, framesPerTick, ledAnimation = buildRenderTables(airports, conditionDict, ledCount, nearestStations)
+    # Started once numpy is loaded, the status page must not be the first to use it from its own thread
+    statusServer = statusserver.startStatusServer(STATUS_HOST, STATUS_PORT, mapStatus.asDict) if STATUS_PORT is not None else None
+
+    # Without animation a single frame is shown, in daemon mode the animation keeps running until the stop file shows up
+    animated = ACTIVATE_WINDCONDITION_ANIMATION or ACTIVATE_LIGHTNING_ANIMATION or ACTIVATE_EXTERNAL_METAR_DISPLAY
+    currentDate = datetime.now().date()
+
+    # Leave the LEDs as they are until the first weather has arrived. A single run only lasts until the next refresh.sh,
+    # so it waits for the current weather instead of starting with the cached one
+    (fetcher.ready if runAsDaemon else fetcher.refreshed).wait(METAR_FETCH_TIMEOUT)
+
+    frameNumber = 0
+    frameSaved = True
+    displayTime = 0.0
+    displayAirportCounter = 0
+    lastTimingLog = monotonic()
+    # Frames are scheduled against fixed deadlines, so the time a frame takes doesn't add up to a slower animation.
+    # The run ends at a deadline as well, so refresh.sh starts the next one after BLINK_TOTALTIME_SECONDS however long the frames took.
+    runStart = monotonic()
+    runEnd = runStart + BLINK_TOTALTIME_SECONDS
+    nextFrame = runStart
+    while runAsDaemon or (monotonic() < runEnd if animated else frameNumber == 0):
+        frameStart = perf_counter()
+        # Pick up a newly published snapshot from the fetcher thread
+        if fetcher.snapshot is not snapshot:
+            snapshot = fetcher.snapshot
+            conditionDict, stationList = snapshot.conditionDict, snapshot.stationList
+            stageStart = perf_counter()
+            # Unchanged refreshes publish a new snapshot as well, only new weather is worth writing to the SD card
+            if updateStations(stationStore, airports, ledIndex, conditionDict, ledAnimation, nearestStations):
+                frameSaved = False
+            stageTimer.record("stations", perf_counter() - stageStart)
+            if snapshotLog is not None:
+                try:
+                    snapshotLog.append(time_now() - (monotonic() - snapshot.fetchedAt), {stationId: condition.asDict() for stationId, condition in conditionDict.items()})
+                except OSError as e:
+                    log.error("Error recording the weather to " + METAR_LOG_FILE + ": " + str(e))
+        if snapshot is not None and conditionDict and METAR_MAX_AGE_SECONDS != -1 and monotonic() - snapshot.fetchedAt > METAR_MAX_AGE_SECONDS:
+            log.warning("METARs are older than " + str(METAR_MAX_AGE_SECONDS) + " seconds, clearing map")
+            conditionDict, stationList = {}, []
+            updateStations(stationStore, airports, ledIndex, conditionDict, ledAnimation, nearestStations)
+
+        if snapshot is not None:
+            brightnessAdjustments = None
+            if USE_DYNAMIC_SUNTIME:
+                stageStart = perf_counter()
+                if sunSchedule.day != datetime.now().date():
+                    sunSchedule = SunSchedule(airports, suntimes, datetime.now().date(), ledCount)
+                brightnessAdjustments = sunSchedule.brightness(time_now())
+                stageTimer.record("brightness", perf_counter() - stageStart)
+            # Update actual LEDs all at once
+            stageStart = perf_counter()
+            colors = ledAnimation.frame(frameNumber, brightnessAdjustments)
+            stageEnd = perf_counter()
+            stageTimer.record("colors", stageEnd - stageStart)
+            pixels.setFrame(colors)
+            pixels.show()
+            stageTimer.record("show", perf_counter() - stageEnd)
+            mapStatus.recordFrame(colors, brightnessAdjustments)
+            # The first frame with new weather is shown again at the next start, without a wind or lightning flash caught mid-animation
+            if not frameSaved:
+                saveFrameCache(ledAnimation.steadyFrame(brightnessAdjustments), strips[0].brightness)
+                frameSaved = True
+        stageTimer.record("frame", perf_counter() - frameStart)
+
+        nextFrame += framePeriod
+        delay = nextFrame - monotonic()
+        if delay > 0:
+            sleep(delay)
+            stageTimer.record("drift", max(0.0, monotonic() - nextFrame))
         else:
-            displayTime = 0.0
-            displayAirportCounter = displayAirportCounter + 1 if displayAirportCounter < numAirports-1 else 0
-            print("showing METAR Display for " + stationList[displayAirportCounter])
+            # This frame missed its deadline, continue from now instead of rushing through the missed frames
+            stageTimer.overruns += 1
+            nextFrame = monotonic()
+        frameNumber += 1
+        if frameNumber % framesPerTick != 0:
+            continue
+
+        # Rotate through airports METAR on external display
+        if disp is not None and len(stationList) > 0:
+            if displayAirportCounter >= len(stationList):
+                displayAirportCounter = 0
+            if displayTime <= DISPLAY_ROTATION_SPEED:
+                stageStart = perf_counter()
+                displaymetar.outputMetar(disp, stationList[displayAirportCounter], conditionDict.get(stationList[displayAirportCounter], None))
+                stageTimer.record("display", perf_counter() - stageStart)
+                displayTime += BLINK_SPEED
+            else:
+                displayTime = 0.0
+                displayAirportCounter = displayAirportCounter + 1 if displayAirportCounter < len(stationList)-1 else 0
+                log.debug("showing METAR Display for " + stationList[displayAirportCounter])
+
+        # Apply a changed config file without restarting, the weather and the animation keep running
+        if getConfigMtime() != configMtime:
+            configMtime = getConfigMtime()
+            settings = loadConfig()
+            previous = {name: globals()[name] for name in CONFIG_SETTINGS}
+            changed = applyConfig(settings, configDefaults, False) if settings is not None else set()
+            if changed:
+                log.info("Applied " + ", ".join(sorted(changed)) + " from " + CONFIG_FILE)
+            # A combination of settings that still fails is rolled back, and everything is rebuilt from the previous settings
+            for rollback in (False, True) if changed else ():
+                try:
+                    setupLogging()
+                    # Rebuild everything derived from the settings once, instead of reading the settings every frame
+                    for condition in conditionDict.values():
+                        if condition.windGustSpeed:
+                            condition.windGust = isGustAnimated(condition.windGustSpeed)
+                    if changed & {"INTERPOLATE_MISSING", "INTERPOLATION_RADIUS_NM"}:
+                        nearestStations = getNearestStations(airports, positions)
+                    framePeriod, framesPerTick, ledAnimation = buildRenderTables(airports, conditionDict, ledCount, nearestStations)
+                    sunSchedule = SunSchedule(airports, suntimes, datetime.now().date(), ledCount)
+                    brightTimeStart, dimTimeStart = getDimmingTimes()
+                    for strip in strips:
+                        strip.brightness = getStripBrightness(brightTimeStart, dimTimeStart)
+                    pixels.invalidate()
+                    runEnd = runStart + BLINK_TOTALTIME_SECONDS
+                    fetcher.refreshSeconds = METAR_REFRESH_SECONDS
+                    fetcher.timeout = METAR_FETCH_TIMEOUT
+                    fetcher.retries = METAR_FETCH_RETRIES
+                    fetcher.backoff = METAR_RETRY_BACKOFF
+                    fetcher.maxAge = METAR_MAX_AGE_SECONDS if METAR_MAX_AGE_SECONDS != -1 else None
+                    if PROFILE_FILE != profilePath:
+                        if profiler is not None:
+                            stopProfiler(profiler, profilePath)
+                        profilePath = PROFILE_FILE
+                        profiler = startProfiler() if profilePath is not None else None
+                    break
+                except Exception as e:
+                    if rollback:
+                        raise
+                    log.error("Error applying the settings from " + CONFIG_FILE + ", going back to the previous settings: " + str(e))
+                    globals().update(previous)
+
+        if TIMING_LOG_SECONDS > 0 and monotonic() - lastTimingLog >= TIMING_LOG_SECONDS:
+            lastTimingLog = monotonic()
+            log.info(stageTimer.summary())
+
+        if not runAsDaemon:
+            continue
+        if os.path.exists(STOP_FILE):
+            log.info("Found " + STOP_FILE + ", stopping")
+            break
+
+        # A new day needs new dimming times and a fresh suntimes.csv
+        if datetime.now().date() != currentDate:
+            currentDate = datetime.now().date()
+            brightTimeStart, dimTimeStart = getDimmingTimes()
+            if USE_DYNAMIC_SUNTIME:
+                refreshSuntimesIfStale()
+        if ACTIVATE_DAYTIME_DIMMING and strips[0].brightness != getStripBrightness(brightTimeStart, dimTimeStart):
+            for strip in strips:
+                strip.brightness = getStripBrightness(brightTimeStart, dimTimeStart)
+            pixels.invalidate()
+
+        if getSuntimesMtime() != suntimesMtime:
+            stageStart = perf_counter()
+            suntimesMtime = getSuntimesMtime()
+            suntimes = loadSuntimes()
+            sunSchedule = SunSchedule(airports, suntimes, datetime.now().date(), ledCount)
+            stageTimer.record("suntimes", perf_counter() - stageStart)
 
-    # Switching between animation cycles
-    sleep(BLINK_SPEED)
-    windCycle = False if windCycle else True
-    looplimit -= 1
+    fetcher.stop()
+    if statusServer is not None:
+        statusserver.stopStatusServer(statusServer)
+    log.info("Frames rendered: " + str(pixels.framesRendered) + ", skipped unchanged: " + str(pixels.framesSkipped))
+    log.info(stageTimer.summary())
+    if profiler is not None:
+        stopProfiler(profiler, profilePath)
+    log.info("Done")
 
-print()
-print("Done")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+import os
+import gzip
+import zlib
+import json
+import queue
+import logging
+import threading
+import http.client
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, perf_counter, time
+
+# This file fetches the METARs from aviationweather.gov in a background thread,
+# so a slow or unreachable server never holds up the LED animation
+
+log = logging.getLogger("metar.fetch")
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/86.0.4240.198 Safari/537.36 Edg/86.0.622.69'
+
+# Redirects are followed on kept-alive connections as well, up to MAX_REDIRECTS in a row
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+MAX_REDIRECTS = 5
+
+# One complete set of parsed conditions, fetchedAt is a monotonic() timestamp and shards the number of shards it was merged from
+MetarSnapshot = namedtuple("MetarSnapshot", ["fetchedAt", "conditionDict", "stationList", "shards"])
+
+def buildUrl(airports, hoursBeforeNow = 5):
+    # Details about parameters can be found here: https://www.aviationweather.gov/dataserver/example?datatype=metar
+    return "https://aviationweather.gov/cgi-bin/data/metar.php?url_options&ids=" + ",".join([item for item in airports if item != "NULL"]) + "&format=xml&hours=" + str(hoursBeforeNow) + "&order=-obs"
+
+def buildUrls(airports, hoursBeforeNow = 5, shardSize = 0):
+    """URLs requesting the airports in shards of at most shardSize stations, a single URL for all of them if shardSize is 0"""
+    codes = list(dict.fromkeys(item for item in airports if item != "NULL"))
+    if not shardSize or shardSize <= 0 or len(codes) <= shardSize:
+        return [buildUrl(codes, hoursBeforeNow)]
+    return [buildUrl(codes[i:i + shardSize], hoursBeforeNow) for i in range(0, len(codes), shardSize)]
+
+class ConnectionPool:
+    """Keeps HTTPS connections open between requests, so each request doesn't need a new connection and TLS handshake
+
+    Idle connections are kept per scheme, host and port, so a redirect to another host doesn't take over the connections of the first.
+    """
+
+    def __init__(self):
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def idleConnections(self, parts):
+        with self.lock:
+            return self.idle.setdefault((parts.scheme, parts.hostname, parts.port), queue.LifoQueue())
+
+    def request(self, url, headers, timeout):
+        """GET url, returns (status, reason, headers, body)"""
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path + ("?" + parts.query if parts.query else "")
+        idle = self.idleConnections(parts)
+        try:
+            connection = idle.get_nowait()
+            reused = True
+        except queue.Empty:
+            connectionClass = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+            connection = connectionClass(parts.hostname, parts.port, timeout = timeout)
+            reused = False
+        try:
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            connection.request("GET", path, headers = headers)
+            response = connection.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            if not reused:
+                raise
+            # The server may have closed the idle connection in the meantime, try once more on a new one
+            return self.request(url, headers, timeout)
+        if response.will_close:
+            connection.close()
+        else:
+            idle.put(connection)
+        return response.status, response.reason, response.headers, body
+
+    def close(self):
+        with self.lock:
+            idleQueues = list(self.idle.values())
+        for idle in idleQueues:
+            while not idle.empty():
+                idle.get_nowait().close()
+
+def usesProxy(url):
+    """Whether a proxy from the environment, e.g. https_proxy, applies to url, the pool only makes direct connections"""
+    parts = urllib.parse.urlsplit(url)
+    return parts.scheme in urllib.request.getproxies() and not urllib.request.proxy_bypass(parts.hostname or "")
+
+def decodeContent(content, encoding):
+    """The body of a response, unpacked if it was sent gzipped"""
+    if encoding != 'gzip':
+        return content
+    try:
+        return gzip.decompress(content)
+    except (OSError, EOFError, zlib.error) as e:
+        # A truncated or corrupt body is a failed fetch like any other network error
+        raise OSError("Invalid gzip response: " + str(e))
+
+def fetchUrl(url, timeout, etag = None, lastModified = None, pool = None):
+    """Fetch url, returns (content, etag, lastModified) or None if the server reports it has not been modified
+
+    With a ConnectionPool the request is made over one of its kept-alive connections, following redirects like urlopen does.
+    Requests that have to go through a proxy are made with urlopen.
+    """
+    headers = {'User-Agent': USER_AGENT, 'Accept-Encoding': 'gzip'}
+    if etag:
+        headers['If-None-Match'] = etag
+    if lastModified:
+        headers['If-Modified-Since'] = lastModified
+    for redirects in range(MAX_REDIRECTS + 1):
+        if pool is None or usesProxy(url):
+            break
+        try:
+            status, reason, responseHeaders, content = pool.request(url, headers, timeout)
+        except http.client.HTTPException as e:
+            # Report broken responses like any other network error
+            raise OSError("Invalid response: " + repr(e))
+        if status in REDIRECT_STATUSES and responseHeaders.get('Location'):
+            location = urllib.parse.urljoin(url, responseHeaders.get('Location'))
+            if urllib.parse.urlsplit(location).scheme not in ("http", "https"):
+                raise urllib.error.HTTPError(url, status, "Redirect to " + location + " is not allowed", responseHeaders, None)
+            url = location
+            continue
+        if status == 304:
+            return None
+        if status != 200:
+            raise urllib.error.HTTPError(url, status, reason, responseHeaders, None)
+        return decodeContent(content, responseHeaders.get('Content-Encoding')), responseHeaders.get('ETag'), responseHeaders.get('Last-Modified')
+    else:
+        raise urllib.error.HTTPError(url, status, "Too many redirects", responseHeaders, None)
+    req = urllib.request.Request(url, headers=headers)
+    try:
+        with urllib.request.urlopen(req, timeout = timeout) as response:
+            return decodeContent(response.read(), response.headers.get('Content-Encoding')), response.headers.get('ETag'), response.headers.get('Last-Modified')
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None
+        raise
+
+def loadCache(path, url):
+    """Returns (content, meta) of the cached response for url, or None if there is no usable cache"""
+    try:
+        with open(path + ".json") as f:
+            meta = json.load(f)
+        with open(path, "rb") as f:
+            content = f.read()
+    except (OSError, ValueError):
+        return None
+    if meta.get("url") != url:
+        return None
+    return content, meta
+
+def saveCache(path, url, content, etag, lastModified):
+    """Store the response for url, pass content as None to only record that the cached response is still current"""
+    # Write to temporary files first so a power cut never leaves a half written cache behind
+    if content is not None:
+        with open(path + ".tmp", "wb") as f:
+            f.write(content)
+        os.replace(path + ".tmp", path)
+    with open(path + ".json.tmp", "w") as f:
+        json.dump({"url": url, "fetchedAt": time(), "etag": etag, "lastModified": lastModified}, f)
+    os.replace(path + ".json.tmp", path + ".json")
+
+class Shard:
+    """One request for a part of the airports, with its last response and the conditions parsed from it"""
+
+    def __init__(self, url, cachePath):
+        self.url = url
+        self.cachePath = cachePath
+        self.content = None
+        self.etag = None
+        self.lastModified = None
+        self.result = None
+        self.fetchedAt = None
+
+def shardCachePath(cachePath, index):
+    # The first shard keeps the plain name, on.sh checks for it to see if there is a cache at all
+    if cachePath is None or index == 0:
+        return cachePath
+    return cachePath + "." + str(index)
+
+class MetarFetcher(threading.Thread):
+    """Refreshes the METARs every refreshSeconds and publishes each parsed result as a new snapshot
+
+    parse is called with the raw response and has to return (conditionDict, stationList).
+    Readers only ever look at self.snapshot, which is replaced in one assignment once a refresh is complete.
+    Large airport lists are requested in shards of shardSize stations, fetched in parallel over up to
+    connections kept-alive connections. The shards are merged into one snapshot, a failed shard is retried
+    on its own and keeps its previous conditions until they are older than maxAge seconds.
+    If cachePath is set, the last responses are kept on disk, used for conditional requests
+    and published straight away on start-up, so the map lights up even while the network is still down.
+    With refreshOnStart the weather is fetched right away even if the cache is still recent, refreshed is set
+    once that first refresh has succeeded or failed.
+    """
+
+    def __init__(self, airports, parse, refreshSeconds, timeout = 30, retries = 3, backoff = 5.0, cachePath = None, hoursBeforeNow = 5,
+            shardSize = 0, connections = 4, maxAge = None, stageTimer = None, refreshOnStart = False):
+        super().__init__(name = "MetarFetcher", daemon = True)
+        self.shards = [Shard(url, shardCachePath(cachePath, i)) for i, url in enumerate(buildUrls(airports, hoursBeforeNow, shardSize))]
+        self.parse = parse
+        self.refreshSeconds = refreshSeconds
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.cachePath = cachePath
+        self.maxAge = maxAge
+        self.stageTimer = stageTimer
+        self.refreshOnStart = refreshOnStart
+        self.pool = ConnectionPool()
+        self.executor = ThreadPoolExecutor(max_workers = max(1, min(connections, len(self.shards))), thread_name_prefix = "MetarShard")
+        self.snapshot = None
+        self.ready = threading.Event()
+        self.refreshed = threading.Event()
+        self.stopEvent = threading.Event()
+
+    def run(self):
+        wait = self.loadCachedSnapshot()
+        if wait > 0 and not self.refreshOnStart:
+            log.info("Using cached METARs, next refresh in " + str(int(wait)) + "s")
+            self.stopEvent.wait(wait)
+        while not self.stopEvent.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                # Keep the thread alive, otherwise the map would never get new weather again
+                log.exception("Error refreshing METARs, trying again at the next refresh")
+            self.refreshed.set()
+            self.stopEvent.wait(self.refreshSeconds)
+        self.executor.shutdown(wait = False)
+        self.pool.close()
+
+    def loadCachedSnapshot(self):
+        """Publish the cached responses if there are any, returns the seconds until they are due for a refresh"""
+        if self.cachePath is None:
+            return 0
+        ages = []
+        for shard in self.shards:
+            cached = loadCache(shard.cachePath, shard.url)
+            if cached is None:
+                continue
+            content, meta = cached
+            try:
+                result = self.parse(content)
+            except Exception as e:
+                log.warning("Error parsing cached METARs, ignoring cache: " + str(e))
+                continue
+            age = max(0.0, time() - meta.get("fetchedAt", 0))
+            shard.content = content
+            shard.etag = meta.get("etag")
+            shard.lastModified = meta.get("lastModified")
+            shard.result = result
+            shard.fetchedAt = monotonic() - age
+            ages.append(age)
+        if not ages:
+            return 0
+        self.publish(True)
+        # Shards without a cache are fetched right away
+        return self.refreshSeconds - max(ages) if len(ages) == len(self.shards) else 0
+
+    def stop(self):
+        self.stopEvent.set()
+
+    def refresh(self):
+        """Fetch all shards, retrying only the failed ones, returns True if every shard could be fetched"""
+        pending = self.shards
+        attempt = 0
+        fetched = 0
+        changed = False
+        while True:
+            failed = []
+            error = None
+            for shard, outcome in zip(pending, self.executor.map(self.refreshShard, pending)):
+                if isinstance(outcome, Exception):
+                    failed.append(shard)
+                    error = outcome
+                else:
+                    fetched += 1
+                    changed = changed or outcome
+            if not failed:
+                break
+            if attempt >= self.retries or self.stopEvent.is_set():
+                log.warning("Error fetching " + str(len(failed)) + " of " + str(len(self.shards)) + " METAR requests, keeping their previous conditions: " + str(error))
+                break
+            delay = self.backoff * (2 ** attempt)
+            attempt += 1
+            log.warning("Error fetching " + str(len(failed)) + " of " + str(len(self.shards)) + " METAR requests (" + str(error) + "), retry " + str(attempt) + " in " + str(delay) + "s")
+            if self.stopEvent.wait(delay):
+                break
+            pending = failed
+        if fetched > 0:
+            if not changed:
+                # Skip merging, the current conditions are simply confirmed as fresh
+                log.info("METARs not modified")
+            self.publish(changed)
+        return fetched == len(self.shards)
+
+    def recordStage(self, stage, seconds):
+        if self.stageTimer is not None:
+            self.stageTimer.record(stage, seconds)
+
+    def refreshShard(self, shard):
+        """Fetch and parse one shard, returns whether its conditions changed, or the exception it failed with"""
+        log.debug(shard.url)
+        start = perf_counter()
+        try:
+            result = fetchUrl(shard.url, self.timeout, shard.etag, shard.lastModified, self.pool)
+        except OSError as e:
+            # URLError, HTTPError and socket timeouts are all OSErrors
+            return e
+        finally:
+            self.recordStage("fetch", perf_counter() - start)
+        if result is None:
+            # 304 Not Modified, the response we already have is still current
+            content, etag, lastModified = shard.content, shard.etag, shard.lastModified
+        else:
+            content, etag, lastModified = result
+        if shard.result is not None and content == shard.content:
+            shard.fetchedAt = monotonic()
+            self.saveCache(shard, None, etag, lastModified)
+            return False
+        start = perf_counter()
+        try:
+            parsed = self.parse(content)
+        except Exception as e:
+            log.warning("Error parsing METARs, keeping previous conditions: " + str(e))
+            return e
+        finally:
+            self.recordStage("parse", perf_counter() - start)
+        shard.content = content
+        shard.result = parsed
+        shard.fetchedAt = monotonic()
+        self.saveCache(shard, content, etag, lastModified)
+        return True
+
+    def publish(self, changed):
+        """Merge the conditions of all shards into a new snapshot, shards with conditions older than maxAge are left out"""
+        now = monotonic()
+        shards = [shard for shard in self.shards if shard.result is not None]
+        fetchedAt = max(shard.fetchedAt for shard in shards)
+        fresh = [shard for shard in shards if self.maxAge is None or now - shard.fetchedAt <= self.maxAge]
+        if not changed and self.snapshot is not None and len(fresh) == self.snapshot.shards:
+            self.snapshot = self.snapshot._replace(fetchedAt = fetchedAt)
+            return
+        if len(fresh) < len(shards):
+            log.warning(str(len(shards) - len(fresh)) + " of " + str(len(self.shards)) + " METAR requests are outdated, leaving their airports blank")
+        conditionDict = {}
+        stationList = []
+        for shard in fresh:
+            shardConditions, shardStations = shard.result
+            conditionDict.update(shardConditions)
+            stationList += shardStations
+        self.snapshot = MetarSnapshot(fetchedAt, conditionDict, stationList, len(fresh))
+        self.ready.set()
+
+    def saveCache(self, shard, content, etag, lastModified):
+        shard.etag = etag
+        shard.lastModified = lastModified
+        if shard.cachePath is None:
+            return
+        try:
+            saveCache(shard.cachePath, shard.url, content, etag, lastModified)
+        except OSError as e:
+            log.warning("Error writing METAR cache: " + str(e))
@@ -0,0 +1,311 @@
+import os
+import sys
+import json
+import zlib
+import struct
+import bisect
+import logging
+import argparse
+import threading
+from datetime import datetime
+from time import monotonic
+from xml.sax.saxutils import escape
+
+from metarfetch import MetarSnapshot
+
+# Append-only history of the fetched weather, for replays and benchmark fixtures.
+# The log is two files: path holds one record per fetch and path + ".idx" one fixed size
+# (timestamp, offset, keyframe) entry per record, so any point in time can be found with a binary search.
+# A record only holds the stations that changed since the previous one, every KEYFRAME_EVERY
+# records a keyframe holds all stations, so a lookup never has to apply more than that many records.
+# Within a record the stations are stored column by column and compressed with zlib.
+
+log = logging.getLogger("metar.log")
+
+KEYFRAME_EVERY = 48   # With the default 5 minute refresh that is one keyframe every 4 hours
+
+RECORD_HEADER = struct.Struct("<IdB")   # payload length, UTC epoch timestamp, keyframe flag
+INDEX_ENTRY = struct.Struct("<dQB")     # UTC epoch timestamp, offset of the record, keyframe flag
+
+def encodeRecord(stations, removed):
+    """Compress the fields of stations (stationId -> dict of fields) and the ids of removed stations"""
+    fields = sorted({name for values in stations.values() for name in values})
+    ids = sorted(stations)
+    columns = [[stations[stationId].get(name) for stationId in ids] for name in fields]
+    return zlib.compress(json.dumps({"ids": ids, "fields": fields, "columns": columns, "removed": sorted(removed)}, separators=(",", ":")).encode(), 9)
+
+def decodeRecord(payload):
+    """(stations, removed) of a compressed record"""
+    record = json.loads(zlib.decompress(payload))
+    stations = {stationId: {} for stationId in record["ids"]}
+    for name, column in zip(record["fields"], record["columns"]):
+        for stationId, value in zip(record["ids"], column):
+            stations[stationId][name] = value
+    return stations, record["removed"]
+
+class SnapshotLog:
+    """Reads and appends records of the station conditions, every station is stored as a dict of its fields"""
+
+    def __init__(self, path, keyframeEvery = KEYFRAME_EVERY):
+        self.path = path
+        self.indexPath = path + ".idx"
+        self.keyframeEvery = keyframeEvery
+        self.times = []
+        self.offsets = []
+        self.keyframes = []
+        self.sinceKeyframe = None
+        self.stations = {}
+        self.loadIndex()
+
+    def loadIndex(self):
+        """Read the index and drop a record that was only partly written, e.g. on a power cut"""
+        try:
+            dataSize = os.path.getsize(self.path)
+        except OSError:
+            dataSize = 0
+        try:
+            with open(self.indexPath, "rb") as f:
+                data = f.read()
+            entries = INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size])
+        except FileNotFoundError:
+            if dataSize == 0:
+                return
+            # Without the index the next append would cut off the whole log, so it is rebuilt from the records
+            log.warning("No index for " + self.path + ", rebuilding it")
+            entries = self.scanRecords(dataSize)
+            with open(self.indexPath + ".tmp", "wb") as f:
+                f.write(b"".join(INDEX_ENTRY.pack(*entry) for entry in entries))
+            os.replace(self.indexPath + ".tmp", self.indexPath)
+        for timestamp, offset, keyframe in entries:
+            # The data file is not synced, after a power cut it can end before a record the index points to
+            if offset + RECORD_HEADER.size > dataSize:
+                break
+            if keyframe:
+                self.keyframes.append(len(self.offsets))
+            self.times.append(timestamp)
+            self.offsets.append(offset)
+        if self.offsets:
+            # The last record must be complete as well
+            length, timestamp, keyframe = self.readHeader(self.offsets[-1])
+            if self.offsets[-1] + RECORD_HEADER.size + length > dataSize:
+                self.times.pop()
+                self.offsets.pop()
+                if self.keyframes and self.keyframes[-1] == len(self.offsets):
+                    self.keyframes.pop()
+        if self.offsets and self.keyframes:
+            # Continue from the last record, so a restart only writes the changes instead of another keyframe
+            try:
+                self.stations = self.stateAt(len(self.offsets) - 1)
+            except (OSError, ValueError, zlib.error) as e:
+                log.warning("Error reading the last record of " + self.path + ", starting with a keyframe: " + str(e))
+                self.stations = {}
+            else:
+                self.sinceKeyframe = len(self.offsets) - 1 - self.keyframes[-1]
+
+    def scanRecords(self, dataSize):
+        """(timestamp, offset, keyframe) of every complete record, read from the record headers"""
+        entries = []
+        offset = 0
+        with open(self.path, "rb") as f:
+            while offset + RECORD_HEADER.size <= dataSize:
+                f.seek(offset)
+                length, timestamp, keyframe = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+                if offset + RECORD_HEADER.size + length > dataSize:
+                    break
+                entries.append((timestamp, offset, keyframe))
+                offset += RECORD_HEADER.size + length
+        return entries
+
+    def readHeader(self, offset):
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+
+    def append(self, timestamp, stations):
+        """Record the state of all stations at timestamp, only the changes since the last append are written"""
+        # Compare the stations the way they are read back from the log, e.g. tuples come back as lists
+        stations = json.loads(json.dumps(stations))
+        if self.times and timestamp < self.times[-1]:
+            # The clock went backwards, e.g. a Pi without a real time clock before it synced the time.
+            # The records have to stay in order for the binary search, so this one is filed at the time of the last one.
+            log.warning("Clock is earlier than the last record of " + self.path + ", recording at the time of the last record")
+            timestamp = self.times[-1]
+        changed = {stationId: values for stationId, values in stations.items() if self.stations.get(stationId) != values}
+        removed = [stationId for stationId in self.stations if stationId not in stations]
+        # The first record after opening the log is a keyframe, the state before it is unknown
+        keyframe = self.sinceKeyframe is None or self.sinceKeyframe + 1 >= self.keyframeEvery
+        if not keyframe and not changed and not removed:
+            return False
+        payload = encodeRecord(stations if keyframe else changed, [] if keyframe else removed)
+        self.truncate()
+        with open(self.path, "ab") as f:
+            offset = f.tell()
+            f.write(RECORD_HEADER.pack(len(payload), timestamp, 1 if keyframe else 0) + payload)
+        # The index entry is written last, so it never points to a record that is not complete
+        with open(self.indexPath, "ab") as f:
+            f.write(INDEX_ENTRY.pack(timestamp, offset, 1 if keyframe else 0))
+        self.times.append(timestamp)
+        self.offsets.append(offset)
+        if keyframe:
+            self.keyframes.append(len(self.offsets) - 1)
+            self.sinceKeyframe = 0
+        else:
+            self.sinceKeyframe += 1
+        self.stations = dict(stations)
+        return True
+
+    def truncate(self):
+        """Cut off anything after the last complete record, left behind by an interrupted write"""
+        end = self.offsets[-1] + RECORD_HEADER.size + self.readHeader(self.offsets[-1])[0] if self.offsets else 0
+        for path, size in ((self.path, end), (self.indexPath, len(self.offsets) * INDEX_ENTRY.size)):
+            try:
+                if os.path.getsize(path) > size:
+                    os.truncate(path, size)
+            except FileNotFoundError:
+                pass
+
+    def readRecord(self, i):
+        """(timestamp, keyframe, stations, removed) of record i"""
+        with open(self.path, "rb") as f:
+            f.seek(self.offsets[i])
+            length, timestamp, keyframe = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+            stations, removed = decodeRecord(f.read(length))
+        return timestamp, keyframe, stations, removed
+
+    def find(self, timestamp):
+        """Index of the last record at or before timestamp, or the first record if there is none before it"""
+        return max(0, bisect.bisect_right(self.times, timestamp) - 1)
+
+    def stateAt(self, i):
+        """State of all stations after record i, rebuilt from the keyframe before it"""
+        start = self.keyframes[bisect.bisect_right(self.keyframes, i) - 1] if self.keyframes and self.keyframes[0] <= i else 0
+        state = {}
+        for j in range(start, i + 1):
+            timestamp, keyframe, stations, removed = self.readRecord(j)
+            if keyframe:
+                state = {}
+            state.update(stations)
+            for stationId in removed:
+                state.pop(stationId, None)
+        return state
+
+    def replay(self, start, end = None):
+        """Yields (timestamp, state of all stations) of every record from start up to end"""
+        if not self.times:
+            return
+        i = self.find(start)
+        state = self.stateAt(i)
+        yield self.times[i], dict(state)
+        for j in range(i + 1, len(self.times)):
+            if end is not None and self.times[j] > end:
+                return
+            timestamp, keyframe, stations, removed = self.readRecord(j)
+            if keyframe:
+                state = {}
+            state.update(stations)
+            for stationId in removed:
+                state.pop(stationId, None)
+            yield timestamp, dict(state)
+
+class ReplayFetcher(threading.Thread):
+    """Publishes the recorded weather as snapshots, speed times faster than it was recorded
+
+    Stands in for metarfetch.MetarFetcher, build turns the state of all stations into (conditionDict, stationList).
+    """
+
+    def __init__(self, snapshotLog, build, start, speed):
+        super().__init__(name = "ReplayFetcher", daemon = True)
+        self.snapshotLog = snapshotLog
+        self.build = build
+        self.startTime = start
+        self.speed = speed
+        self.shards = []
+        self.snapshot = None
+        self.replayTime = None
+        self.ready = threading.Event()
+        self.stopEvent = threading.Event()
+
+    def run(self):
+        previous = None
+        for timestamp, state in self.snapshotLog.replay(self.startTime):
+            if previous is not None and self.stopEvent.wait((timestamp - previous) / self.speed):
+                return
+            previous = timestamp
+            conditionDict, stationList = self.build(state)
+            log.info("Replaying weather of " + datetime.fromtimestamp(timestamp).strftime('%d/%m/%Y %H:%M'))
+            self.replayTime = timestamp
+            self.snapshot = MetarSnapshot(monotonic(), conditionDict, stationList, 0)
+            self.ready.set()
+        if self.snapshot is None:
+            log.warning("No weather recorded in " + self.snapshotLog.path + " to replay")
+            self.ready.set()
+            return
+        log.info("Replay finished, showing the last recorded weather")
+        # Keep the last recorded weather fresh, the map would be cleared as outdated otherwise
+        while not self.stopEvent.wait(60):
+            self.snapshot = self.snapshot._replace(fetchedAt = monotonic())
+
+    def stop(self):
+        self.stopEvent.set()
+
+def toXml(state):
+    """A response in the format of aviationweather.gov with the recorded stations, e.g. for benchmark fixtures"""
+    def element(name, value):
+        return "      <" + name + ">" + escape(str(value)) + "</" + name + ">\n"
+    metars = []
+    for stationId in sorted(state):
+        values = state[stationId]
+        text = "    <METAR>\n"
+        text += element("raw_text", values.get("rawText") or "")
+        text += element("station_id", stationId)
+        if values.get("obsTime"):
+            text += element("observation_time", values["obsTime"].replace("+00:00", "Z"))
+        for name, tag in (("tempC", "temp_c"), ("dewpointC", "dewpoint_c"), ("windDir", "wind_dir_degrees"), ("windSpeed", "wind_speed_kt")):
+            if values.get(name) not in (None, ""):
+                text += element(tag, values[name])
+        if values.get("windGustSpeed"):
+            text += element("wind_gust_kt", values["windGustSpeed"])
+        for name, tag in (("vis", "visibility_statute_mi"), ("altimHg", "altim_in_hg")):
+            if values.get(name) is not None:
+                text += element(tag, values[name])
+        if values.get("obs"):
+            text += element("wx_string", values["obs"])
+        for cover, base in values.get("skyConditions") or []:
+            text += '      <sky_condition sky_cover="' + escape(str(cover)) + '" cloud_base_ft_agl="' + str(base) + '" />\n'
+        if values.get("flightCategory"):
+            text += element("flight_category", values["flightCategory"])
+        text += "    </METAR>\n"
+        metars.append(text)
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n<response version="1.3">\n  <request_index>0</request_index>\n'
+        + '  <data_source name="metars" />\n  <request type="retrieve" />\n  <errors />\n  <warnings />\n'
+        + '  <time_taken_ms>0</time_taken_ms>\n  <data num_results="' + str(len(state)) + '">\n'
+        + "".join(metars) + "  </data>\n</response>\n")
+
+def parseTime(value):
+    """Epoch seconds of a local time given as YYYY-MM-DD HH:MM"""
+    return datetime.strptime(value, "%Y-%m-%d %H:%M").timestamp()
+
+if __name__ == '__main__':
+    # python3 metarlog.py list metarlog.bin                       shows the recorded fetches
+    # python3 metarlog.py export metarlog.bin "2024-05-01 12:00"  writes the weather at that time as a METAR response
+    parser = argparse.ArgumentParser(description="Show or export the weather recorded by metar.py")
+    parser.add_argument("command", choices=["list", "export"])
+    parser.add_argument("log", help="the METAR_LOG_FILE of metar.py")
+    parser.add_argument("time", nargs="?", help="local time to export as YYYY-MM-DD HH:MM, the newest record by default")
+    parser.add_argument("--output", help="file to export to instead of standard output")
+    args = parser.parse_args()
+    snapshotLog = SnapshotLog(args.log)
+    if not snapshotLog.times:
+        sys.exit("No records in " + args.log)
+    if args.command == "list":
+        for offset in snapshotLog.offsets:
+            length, timestamp, keyframe = snapshotLog.readHeader(offset)
+            print(datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S') + ("  keyframe " if keyframe else "  changes  ") + str(length) + " bytes")
+    else:
+        i = snapshotLog.find(parseTime(args.time)) if args.time else len(snapshotLog.times) - 1
+        xml = toXml(snapshotLog.stateAt(i))
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(xml)
+        else:
+            sys.stdout.write(xml)
@@ -24,7 +24,10 @@ wait_for_internet() {
 }
 
 # Call the function to wait for internet connection
-wait_for_internet || exit 1
+# With a cached METAR response metar.py can light up the map without it and will fetch the weather once the network is up
+if [ ! -f metarcache.xml ]; then
+  wait_for_internet || exit 1
+fi
 
 # Path to the suntimes.csv file
 SUNTIMES_CSV="suntimes.csv"
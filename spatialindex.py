@@ -0,0 +1,79 @@
+import math
+
+# Finds the airports around every LED, so LEDs without weather of their own can show the weather nearby.
+# The airports are sorted into a grid of cells about one search radius wide, so a lookup only has to
+# check the airports in the cells around an LED instead of every airport on the map.
+# The neighbours of every LED are looked up once, new weather only needs a walk along those lists.
+
+EARTH_RADIUS_NM = 3440.065
+
+def distanceNm(lat1, lon1, lat2, lon2):
+    """Great circle distance in nautical miles between two positions in degrees"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_NM * math.asin(min(1.0, math.sqrt(a)))
+
+class StationGrid:
+    """Positions of the airports, sorted into cells of at most cellDegrees latitude and longitude"""
+
+    def __init__(self, positions, cellDegrees):
+        # A whole number of cells around the globe, so the cells line up across the date line
+        self.columns = max(1, int(math.ceil(360.0 / cellDegrees)))
+        self.cellDegrees = 360.0 / self.columns
+        self.cells = {}
+        for stationId, (lat, lon) in positions.items():
+            self.cells.setdefault(self.cell(lat, lon), []).append((stationId, lat, lon))
+
+    def cell(self, lat, lon):
+        return int(math.floor(lat / self.cellDegrees)), int(math.floor(lon / self.cellDegrees)) % self.columns
+
+    def nearby(self, lat, lon, radiusNm):
+        """(distance, stationId) of every airport within radiusNm of the position, nearest first"""
+        radiusDegrees = radiusNm / 60.0
+        latCells = int(math.ceil(radiusDegrees / self.cellDegrees))
+        # A degree of longitude gets shorter towards the poles, so more columns have to be searched there
+        cosLat = math.cos(math.radians(min(abs(lat) + radiusDegrees, 89.0)))
+        lonCells = min(self.columns, int(math.ceil(radiusDegrees / cosLat / self.cellDegrees)))
+        row, column = self.cell(lat, lon)
+        columns = {(column + offset) % self.columns for offset in range(-lonCells, lonCells + 1)}
+        found = []
+        for r in range(row - latCells, row + latCells + 1):
+            for c in columns:
+                for stationId, stationLat, stationLon in self.cells.get((r, c), ()):
+                    distance = distanceNm(lat, lon, stationLat, stationLon)
+                    if distance <= radiusNm:
+                        found.append((distance, stationId))
+        found.sort()
+        return found
+
+class NearestStations:
+    """Airports within radiusNm of every LED with a position, nearest first, and the LEDs every airport is a neighbour of
+
+    positions holds the (lat, lon) of every LED, or None for LEDs without one.
+    """
+
+    def __init__(self, airports, positions, radiusNm):
+        stationPositions = {code: position for code, position in zip(airports, positions) if code != "NULL" and position is not None}
+        grid = StationGrid(stationPositions, max(radiusNm, 1.0) / 60.0)
+        self.neighbours = {}
+        self.dependents = {}
+        for i, (code, position) in enumerate(zip(airports, positions)):
+            if position is None:
+                continue
+            stations = [stationId for distance, stationId in grid.nearby(position[0], position[1], radiusNm) if stationId != code]
+            if not stations:
+                continue
+            self.neighbours[i] = stations
+            for stationId in stations:
+                self.dependents.setdefault(stationId, []).append(i)
+
+    def nearest(self, i, isReporting):
+        """Nearest airport to LED i for which isReporting(stationId) is true, None if there is none within the radius"""
+        for stationId in self.neighbours.get(i, ()):
+            if isReporting(stationId):
+                return stationId
+        return None
+
+    def affected(self, stationIds):
+        """LEDs that may be filled from a different airport once the conditions of stationIds changed"""
+        return {i for stationId in stationIds for i in self.dependents.get(stationId, ())}
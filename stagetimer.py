@@ -0,0 +1,49 @@
+from collections import deque
+
+# Rolling timings of the stages of metar.py, e.g. fetching, parsing, computing the colors and writing the LEDs.
+# Every stage keeps its last samples, so the percentiles always describe the recent behaviour of the map.
+# Stages can be recorded from any thread, appending to a deque is thread safe.
+
+class StageTimer:
+    """Durations in seconds of the last window samples of every stage, and the number of frames that missed their deadline"""
+
+    def __init__(self, window = 1000):
+        self.window = window
+        self.samples = {}
+        self.counts = {}
+        self.overruns = 0
+
+    def record(self, stage, seconds):
+        samples = self.samples.get(stage)
+        if samples is None:
+            samples = self.samples.setdefault(stage, deque(maxlen = self.window))
+        samples.append(seconds)
+        self.counts[stage] = self.counts.get(stage, 0) + 1
+
+    def percentiles(self, stage, points = (50, 95, 99)):
+        """Durations at the given percentiles of the recent samples of stage, None if there are none"""
+        samples = sorted(self.samples.get(stage, ()))
+        if not samples:
+            return None
+        return [samples[min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))] for p in points]
+
+    def asDict(self):
+        """Count and p50, p95, p99 and max in milliseconds of every stage"""
+        stages = {}
+        for stage in sorted(self.samples):
+            p50, p95, p99 = self.percentiles(stage)
+            stages[stage] = {
+                "count": self.counts[stage],
+                "p50Ms": round(p50 * 1000, 3),
+                "p95Ms": round(p95 * 1000, 3),
+                "p99Ms": round(p99 * 1000, 3),
+                "maxMs": round(max(self.samples[stage]) * 1000, 3)}
+        return {"stages": stages, "overruns": self.overruns}
+
+    def summary(self):
+        """One line with the median and 95th percentile of every stage"""
+        parts = []
+        for stage in sorted(self.samples):
+            p50, p95 = self.percentiles(stage, (50, 95))
+            parts.append("%s %.2f/%.2f" % (stage, p50 * 1000, p95 * 1000))
+        return "Timing p50/p95 ms: " + ", ".join(parts) + ", overruns " + str(self.overruns)
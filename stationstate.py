@@ -0,0 +1,65 @@
+from collections import deque, namedtuple
+
+# Keeps the conditions of the last snapshot, so a new snapshot can be compared station by station.
+# Only the stations that changed have to be redrawn, and the changes are reported as transition events.
+
+# Kinds of transition
+EVENT_NEW = "new"                           # Station reported for the first time
+EVENT_LOST = "lost"                         # Station is no longer reported
+EVENT_CATEGORY = "category"                 # Flight category changed, e.g. VFR to IFR
+EVENT_LIGHTNING_ONSET = "lightning onset"   # Lightning reported in the vicinity
+EVENT_LIGHTNING_END = "lightning end"       # Lightning no longer reported
+EVENT_UPDATED = "updated"                   # Any other change, e.g. a newer observation
+
+class Transition(namedtuple("Transition", ["kind", "stationId", "old", "new"])):
+    """One change of a station, old and new hold the values that changed"""
+    __slots__ = ()
+
+    def __str__(self):
+        if self.kind == EVENT_CATEGORY:
+            return self.stationId + " " + str(self.old) + "->" + str(self.new)
+        if self.kind in (EVENT_NEW, EVENT_LOST):
+            return self.stationId + " " + self.kind + " (" + str(self.new if self.kind == EVENT_NEW else self.old) + ")"
+        return self.stationId + " " + self.kind
+
+def getTransitions(stationId, old, new):
+    """Transitions between two conditions of one station, either may be None"""
+    if old is None:
+        return [Transition(EVENT_NEW, stationId, None, new.flightCategory)]
+    if new is None:
+        return [Transition(EVENT_LOST, stationId, old.flightCategory, None)]
+    transitions = []
+    if old.flightCategory != new.flightCategory:
+        transitions.append(Transition(EVENT_CATEGORY, stationId, old.flightCategory, new.flightCategory))
+    if new.lightning and not old.lightning:
+        transitions.append(Transition(EVENT_LIGHTNING_ONSET, stationId, False, True))
+    elif old.lightning and not new.lightning:
+        transitions.append(Transition(EVENT_LIGHTNING_END, stationId, True, False))
+    if not transitions:
+        transitions.append(Transition(EVENT_UPDATED, stationId, None, None))
+    return transitions
+
+class StationStore:
+    """Conditions of every station as of the last update, plus the most recent transitions"""
+
+    def __init__(self, historySize = 200):
+        self.conditionDict = {}
+        self.recentEvents = deque(maxlen = historySize)
+
+    def update(self, conditionDict):
+        """Compare conditionDict to the stored conditions and store it, returns (changed station ids, transitions)"""
+        old = self.conditionDict
+        changed = set()
+        events = []
+        for stationId, condition in conditionDict.items():
+            previous = old.get(stationId)
+            if previous is None or previous != condition:
+                changed.add(stationId)
+                events += getTransitions(stationId, previous, condition)
+        for stationId, previous in old.items():
+            if stationId not in conditionDict:
+                changed.add(stationId)
+                events += getTransitions(stationId, previous, None)
+        self.conditionDict = conditionDict
+        self.recentEvents.extend(events)
+        return changed, events
@@ -0,0 +1,55 @@
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A small HTTP server inside metar.py that shows what the map is doing as JSON, e.g.
+# curl http://<pi address>:8080/            everything
+# curl http://<pi address>:8080/leds        only one section of it
+
+log = logging.getLogger("metar.status")
+
+class StatusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        section = self.path.split("?")[0].strip("/")
+        try:
+            status = self.server.getStatus()
+        except Exception as e:
+            log.warning("Error collecting status: " + str(e))
+            self.sendJson(500, {"error": str(e)})
+            return
+        if section == "":
+            self.sendJson(200, status)
+        elif section in status:
+            self.sendJson(200, status[section])
+        else:
+            self.sendJson(404, {"error": "unknown section", "sections": sorted(status)})
+
+    def sendJson(self, code, body):
+        content = json.dumps(body, default=str).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        log.debug("%s " + format, self.address_string(), *args)
+
+def startStatusServer(host, port, getStatus):
+    """Serve the dict returned by getStatus() from a background thread, returns the server or None if the port is not available"""
+    try:
+        server = ThreadingHTTPServer((host, port), StatusHandler)
+    except OSError as e:
+        log.warning("Status page not available, could not listen on port " + str(port) + ": " + str(e))
+        return None
+    server.daemon_threads = True
+    server.getStatus = getStatus
+    threading.Thread(target = server.serve_forever, name = "StatusServer", daemon = True).start()
+    log.info("Status page at http://" + (host or "localhost") + ":" + str(server.server_address[1]) + "/")
+    return server
+
+def stopStatusServer(server):
+    if server is not None:
+        server.shutdown()
+        server.server_close()
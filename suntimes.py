@@ -1,37 +1,148 @@
+import io
 import os
+import sys
 import csv
-import requests
-from datetime import datetime
-
-def get_sun_times(lat, lon):
-    today = datetime.now().strftime('%Y-%m-%d')
-    url = f"https://api.sunrise-sunset.org/json?lat={lat}&lng={lon}&date={today}"
-    response = requests.get(url)
-    data = response.json()
-    return data['results']
-
-def format_time(time_str):
-    return datetime.strptime(time_str, '%I:%M:%S %p').strftime('%H:%M:%S')
-
-# Read airport locations from CSV file and write sun times to output file
-with open('airports.csv', 'r') as input_file, open('suntimes_temp.csv', 'w') as output_file:
-    reader = csv.DictReader(input_file)
-    writer = csv.writer(output_file)
-    writer.writerow(['code', 'twilight_start', 'sunrise', 'sunset', 'twilight_end'])
-    for row in reader:
-        code = row['code']
-        if code == 'NULL':
+import json
+import math
+import tempfile
+from datetime import datetime, date, timedelta
+
+# Civil twilight, sunrise and sunset of every airport, calculated locally with the NOAA solar equations
+# (https://gml.noaa.gov/grad/solcalc/solareqns.PDF), accurate to about a minute.
+# All times are in UTC, formatted as HH:MM:SS like the times returned by api.sunrise-sunset.org
+
+ZENITH_SUNRISE = 90.833   # Sun's upper limb on the horizon, corrected for refraction
+ZENITH_CIVIL = 96.0       # Civil twilight, sun 6 degrees below the horizon
+
+def solar_terms(day):
+    """Equation of time (minutes) and solar declination (radians) at noon of day, shared by all airports"""
+    gamma = 2 * math.pi / 365 * (day.timetuple().tm_yday - 1)
+    eqtime = 229.18 * (0.000075 + 0.001868 * math.cos(gamma) - 0.032077 * math.sin(gamma)
+        - 0.014615 * math.cos(2 * gamma) - 0.040849 * math.sin(2 * gamma))
+    decl = (0.006918 - 0.399912 * math.cos(gamma) + 0.070257 * math.sin(gamma)
+        - 0.006758 * math.cos(2 * gamma) + 0.000907 * math.sin(2 * gamma)
+        - 0.002697 * math.cos(3 * gamma) + 0.00148 * math.sin(3 * gamma))
+    return eqtime, decl
+
+def hour_angle(lat, decl, zenith):
+    """Hour angle in degrees at which the sun reaches zenith, 180 if it stays above it all day and 0 if it never gets there"""
+    lat = math.radians(lat)
+    cos_ha = math.cos(math.radians(zenith)) / (math.cos(lat) * math.cos(decl)) - math.tan(lat) * math.tan(decl)
+    return math.degrees(math.acos(min(1.0, max(-1.0, cos_ha))))
+
+def format_minutes(minutes):
+    seconds = int(round(minutes * 60)) % 86400
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def get_sun_times(locations, day):
+    """Twilight start, sunrise, sunset and twilight end for a list of (lat, lon) on day
+
+    All four times are empty if the sun doesn't set that day (polar day).
+    """
+    eqtime, decl = solar_terms(day)
+    results = []
+    for lat, lon in locations:
+        noon = 720 - 4 * lon - eqtime
+        ha_sun = 4 * hour_angle(lat, decl, ZENITH_SUNRISE)
+        if ha_sun >= 720:
+            results.append(('', '', '', ''))
             continue
-        lat = row['lat']
-        lon = row['lon']
-        sun_times = get_sun_times(lat, lon)
-        writer.writerow([
-            code,
-            format_time(sun_times['civil_twilight_begin']),
-            format_time(sun_times['sunrise']),
-            format_time(sun_times['sunset']),
-            format_time(sun_times['civil_twilight_end'])
-        ])
-
-# Replace old file with new file
-os.replace('suntimes_temp.csv', 'suntimes.csv')
+        ha_civil = 4 * hour_angle(lat, decl, ZENITH_CIVIL)
+        results.append((
+            format_minutes(noon - ha_civil),
+            format_minutes(noon - ha_sun),
+            format_minutes(noon + ha_sun),
+            format_minutes(noon + ha_civil)
+        ))
+    return results
+
+def read_airports(path = 'airports.csv'):
+    """Codes and (lat, lon) of all airports, skipping NULL entries"""
+    with open(path, 'r') as input_file:
+        rows = [row for row in csv.DictReader(input_file) if row['code'] != 'NULL']
+    return [row['code'] for row in rows], [(float(row['lat']), float(row['lon'])) for row in rows]
+
+def year_path(year, output_path = 'suntimes.csv'):
+    """Path of the table written by write_year, next to output_path"""
+    return os.path.join(os.path.dirname(output_path), 'suntimes_%d.csv' % year)
+
+def open_temp(output_path, mode = 'w'):
+    """(path, file) of a new temporary file next to output_path
+
+    Every writer gets its own file, so on.sh and metar.py can update suntimes.csv at the same time.
+    """
+    fd, temp_path = tempfile.mkstemp(prefix = os.path.basename(output_path) + '.', suffix = '.tmp', dir = os.path.dirname(output_path) or '.')
+    os.chmod(temp_path, 0o644)
+    return temp_path, os.fdopen(fd, mode)
+
+def replace_file(temp_path, output_path):
+    try:
+        os.replace(temp_path, output_path)
+    except OSError:
+        os.remove(temp_path)
+        raise
+
+def read_year_day(day, path):
+    """Sun times of every airport on day from a table written by write_year, empty if there is no table
+
+    The index next to the table holds where every day starts, so only the rows of that day are read.
+    """
+    try:
+        with open(path + '.idx', 'r') as index_file:
+            offset, length = json.load(index_file)[day.isoformat()]
+        with open(path, 'rb') as input_file:
+            input_file.seek(offset)
+            lines = input_file.read(length).decode().splitlines()
+    except (OSError, ValueError, KeyError):
+        return {}
+    return {row[1]: tuple(row[2:6]) for row in csv.reader(lines) if len(row) == 6 and row[0] == day.isoformat()}
+
+def write_suntimes(day = None, airports_path = 'airports.csv', output_path = 'suntimes.csv'):
+    """Write the sun times of all airports for day (default today) to output_path
+
+    Times are taken from the precomputed table of the year if there is one, airports missing from it are calculated.
+    """
+    day = day or datetime.now().date()
+    codes, locations = read_airports(airports_path)
+    precomputed = read_year_day(day, year_path(day.year, output_path))
+    missing = [i for i, code in enumerate(codes) if code not in precomputed]
+    calculated = dict(zip([codes[i] for i in missing], get_sun_times([locations[i] for i in missing], day)))
+    temp_path, output_file = open_temp(output_path)
+    with output_file:
+        writer = csv.writer(output_file)
+        writer.writerow(['code', 'twilight_start', 'sunrise', 'sunset', 'twilight_end'])
+        for code in codes:
+            writer.writerow([code] + list(precomputed.get(code) or calculated[code]))
+    # Replace old file with new file
+    replace_file(temp_path, output_path)
+
+def write_year(year, airports_path = 'airports.csv', output_path = None):
+    """Precompute the sun times of all airports for every day of year into one table, with an index of the days"""
+    output_path = output_path or year_path(year)
+    codes, locations = read_airports(airports_path)
+    day = date(year, 1, 1)
+    index = {}
+    temp_path, output_file = open_temp(output_path, 'wb')
+    with output_file:
+        output_file.write(b'date,code,twilight_start,sunrise,sunset,twilight_end\r\n')
+        while day.year == year:
+            rows = io.StringIO()
+            writer = csv.writer(rows)
+            for code, times in zip(codes, get_sun_times(locations, day)):
+                writer.writerow([day.isoformat(), code] + list(times))
+            data = rows.getvalue().encode()
+            index[day.isoformat()] = (output_file.tell(), len(data))
+            output_file.write(data)
+            day += timedelta(days=1)
+    index_path, index_file = open_temp(output_path + '.idx')
+    with index_file:
+        json.dump(index, index_file)
+    replace_file(temp_path, output_path)
+    replace_file(index_path, output_path + '.idx')
+
+if __name__ == '__main__':
+    # python3 suntimes.py writes suntimes.csv for today, python3 suntimes.py --year 2024 writes suntimes_2024.csv
+    if len(sys.argv) > 2 and sys.argv[1] == '--year':
+        write_year(int(sys.argv[2]))
+    else:
+        write_suntimes()